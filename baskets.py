@@ -0,0 +1,66 @@
+from bisect import bisect_left
+from typing import Optional
+
+from cache import CacheNamespace, LRUCache
+from logger import get_logger
+
+logger = get_logger('baskets')
+
+
+class BasketResolver:
+    # Wildberries раскладывает vol по basket-хостам монотонно:
+    # чем больше vol, тем больше номер корзины. Поэтому по ближайшим
+    # известным vol можно угадать корзину и перебирать кандидатов от неё.
+
+    def __init__(
+        self,
+        store: Optional[CacheNamespace] = None,
+        max_size: int = 65536,
+        max_basket: int = 99,
+    ) -> None:
+        self.max_basket = max_basket
+        self._cache: LRUCache[int, int] = LRUCache(max_size, backing=store)
+        self._sorted_vols: Optional[list[int]] = None
+
+        # соседние vol нужны для угадывания корзины, поэтому
+        # карту (она маленькая) читаем с диска целиком
+        if store is not None:
+            self._cache.warm((int(vol), int(basket)) for vol, basket in store.items())
+            logger.info(f"Loaded {len(self._cache)} basket mappings")
+
+    def get(self, vol: str) -> Optional[str]:
+        basket = self._cache.get(int(vol))
+        if basket is None:
+            return None
+        return f'{basket:02d}'
+
+    def put(self, vol: str, basket: str) -> None:
+        self._cache.put(int(vol), int(basket))
+        self._sorted_vols = None
+
+    def invalidate(self, vol: str) -> None:
+        if self._cache.pop(int(vol)) is not None:
+            self._sorted_vols = None
+
+    def stats(self) -> dict:
+        return self._cache.stats()
+
+    def candidates(self, vol: str) -> list[str]:
+        guess = self._estimate(int(vol))
+        baskets = sorted(
+            range(1, self.max_basket + 1),
+            key=lambda num: (abs(num - guess), num),
+        )
+        return [f'{num:02d}' for num in baskets]
+
+    def _estimate(self, vol: int) -> int:
+        if self._sorted_vols is None:
+            self._sorted_vols = sorted(self._cache)
+        vols = self._sorted_vols
+        if not vols:
+            return 1
+
+        pos = bisect_left(vols, vol)
+        neighbours = [vols[i] for i in (pos - 1, pos) if 0 <= i < len(vols)]
+        nearest = min(neighbours, key=lambda known: abs(known - vol))
+        return self._cache.peek(nearest)
@@ -0,0 +1,264 @@
+import atexit
+import json
+import os
+import sqlite3
+from collections import OrderedDict
+from time import time
+from typing import Any, Generic, Hashable, Iterable, Iterator, Optional, TypeVar
+
+from logger import get_logger
+
+logger = get_logger('cache')
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+
+class LRUCache(Generic[K, V]):
+
+    def __init__(self, max_size: int, backing: Optional['CacheNamespace'] = None) -> None:
+        if max_size <= 0:
+            raise ValueError('max_size must be positive')
+        self.max_size = max_size
+        self.backing = backing
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[K, V] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._data
+
+    def __iter__(self) -> Iterator[K]:
+        return iter(self._data)
+
+    def get(self, key: K) -> Optional[V]:
+        try:
+            value = self._data[key]
+        except KeyError:
+            value = self._load(key)
+            if value is None:
+                self.misses += 1
+                return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key: K) -> Optional[V]:
+        value = self._data.get(key)
+        if value is None:
+            value = self._load(key)
+        return value
+
+    def put(self, key: K, value: V) -> None:
+        self._store(key, value)
+        if self.backing is not None:
+            self.backing.put(key, value)
+
+    def pop(self, key: K) -> Optional[V]:
+        if self.backing is not None:
+            self.backing.delete(key)
+        return self._data.pop(key, None)
+
+    def warm(self, items: Iterable[tuple[K, V]]) -> None:
+        # заполнение без записи обратно на диск
+        for key, value in items:
+            self._store(key, value)
+
+    def _store(self, key: K, value: V) -> None:
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def _load(self, key: K) -> Optional[V]:
+        # промах в памяти: лениво подтягиваем значение с диска
+        if self.backing is None:
+            return None
+        value = self.backing.get(key)
+        if value is not None:
+            self._store(key, value)
+        return value
+
+    def items(self) -> list[tuple[K, V]]:
+        return list(self._data.items())
+
+    def clear(self) -> None:
+        self._data.clear()
+        if self.backing is not None:
+            self.backing.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+class PersistentCache:
+    # Кэш на диске (SQLite) для прогрева после рестарта: записи живут ttl
+    # секунд, при переполнении max_entries вытесняются самые давно записанные.
+    # Файл открывается при первом обращении, запись идёт пачками.
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        ttl: float = 7 * 24 * 3600,
+        max_entries: int = 2_000_000,
+        flush_size: int = 1000,
+    ) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.flush_size = flush_size
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pending: dict[tuple[str, str], Optional[tuple[str, float]]] = {}
+
+    def namespace(self, name: str) -> 'CacheNamespace':
+        return CacheNamespace(self, name)
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    namespace  TEXT NOT NULL,
+                    key        TEXT NOT NULL,
+                    value      TEXT NOT NULL,
+                    written_at REAL NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                ) WITHOUT ROWID
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_written_at ON entries (written_at)")
+            conn.commit()
+            self._conn = conn
+            self._evict()
+            atexit.register(self.close)
+            logger.debug(f"Opened persistent cache {self.path}")
+        return self._conn
+
+    def get(self, namespace: str, key: str) -> Optional[Any]:
+        if (namespace, key) in self._pending:
+            pending = self._pending[(namespace, key)]
+            return None if pending is None else json.loads(pending[0])
+
+        row = self._connection().execute(
+            "SELECT value, written_at FROM entries WHERE namespace = ? AND key = ?",
+            (namespace, key)
+        ).fetchone()
+        if row is None or row[1] < time() - self.ttl:
+            return None
+        return json.loads(row[0])
+
+    def items(self, namespace: str) -> list[tuple[str, Any]]:
+        self.flush()
+        rows = self._connection().execute(
+            "SELECT key, value FROM entries WHERE namespace = ? AND written_at >= ?",
+            (namespace, time() - self.ttl)
+        ).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def put(self, namespace: str, key: str, value: Any) -> None:
+        self._pending[(namespace, key)] = (json.dumps(value), time())
+        if len(self._pending) >= self.flush_size:
+            self.flush()
+
+    def delete(self, namespace: str, key: str) -> None:
+        self._pending[(namespace, key)] = None
+        if len(self._pending) >= self.flush_size:
+            self.flush()
+
+    def clear(self, namespace: str) -> None:
+        self._pending = {key: entry for key, entry in self._pending.items() if key[0] != namespace}
+        conn = self._connection()
+        try:
+            conn.execute("DELETE FROM entries WHERE namespace = ?", (namespace,))
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to clear {namespace} in persistent cache {self.path}: {e}")
+
+    def flush(self) -> None:
+        if not self._pending:
+            return
+
+        pending, self._pending = self._pending, {}
+        conn = self._connection()
+        try:
+            conn.executemany(
+                "INSERT OR REPLACE INTO entries (namespace, key, value, written_at) VALUES (?, ?, ?, ?)",
+                [(namespace, key, *entry) for (namespace, key), entry in pending.items() if entry is not None]
+            )
+            conn.executemany(
+                "DELETE FROM entries WHERE namespace = ? AND key = ?",
+                [(namespace, key) for (namespace, key), entry in pending.items() if entry is None]
+            )
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to flush persistent cache {self.path}: {e}")
+
+    def _evict(self) -> None:
+        conn = self._conn
+        conn.execute("DELETE FROM entries WHERE written_at < ?", (time() - self.ttl,))
+        count = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        if count > self.max_entries:
+            conn.execute(
+                """
+                DELETE FROM entries WHERE written_at <= (
+                    SELECT written_at FROM entries ORDER BY written_at LIMIT 1 OFFSET ?
+                )
+                """,
+                (count - self.max_entries - 1,)
+            )
+        conn.commit()
+
+    def close(self) -> None:
+        if self._conn is None:
+            return
+        self.flush()
+        self._evict()
+        self._conn.close()
+        self._conn = None
+
+
+class CacheNamespace:
+
+    def __init__(self, cache: PersistentCache, name: str) -> None:
+        self.cache = cache
+        self.name = name
+
+    @staticmethod
+    def _key(key: Hashable) -> str:
+        return json.dumps(key, separators=(',', ':'))
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        return self.cache.get(self.name, self._key(key))
+
+    def put(self, key: Hashable, value: Any) -> None:
+        self.cache.put(self.name, self._key(key), value)
+
+    def delete(self, key: Hashable) -> None:
+        self.cache.delete(self.name, self._key(key))
+
+    def clear(self) -> None:
+        self.cache.clear(self.name)
+
+    @staticmethod
+    def _unkey(key: str) -> Hashable:
+        # JSON не различает кортежи и списки, а ключи должны быть хешируемыми
+        key = json.loads(key)
+        return tuple(key) if isinstance(key, list) else key
+
+    def items(self) -> list[tuple[Any, Any]]:
+        return [(self._unkey(key), value) for key, value in self.cache.items(self.name)]
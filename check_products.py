@@ -1,40 +1,83 @@
 #!/usr/bin/env python3
 
+import argparse
 import asyncio
+import json
+import logging
+import sys
 from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Optional
+
+import asyncpg
+from rich.console import Console
+from rich.logging import RichHandler
+
 from db.repository import AsyncDatabase
 from logger import get_logger
 
 logger = get_logger('check_products')
 
 
-async def get_database_stats(db: AsyncDatabase) -> dict:
-    async with db.pool.acquire() as conn:
-        total_products = await conn.fetchval("SELECT COUNT(*) FROM products")
-        
-        marketplace_stats = await conn.fetch(
+async def get_database_stats(db: AsyncDatabase, exact: bool = False) -> dict:
+    # запросы независимы, поэтому идут параллельно на разных соединениях пула
+    total_products, marketplace_stats, total_prices, products_with_prices = await asyncio.gather(
+        _fetchval(db, "SELECT COUNT(*) FROM products"),
+        _fetch(
+            db,
             """
             SELECT marketplace, COUNT(*) as count
             FROM products
             GROUP BY marketplace
             ORDER BY count DESC
             """
-        )
-        
-        total_prices = await conn.fetchval("SELECT COUNT(*) FROM prices")
-        
-        products_with_prices = await conn.fetchval(
+        ),
+        count_prices(db) if exact else estimate_prices(db),
+        _fetchval(
+            db,
+            "SELECT COUNT(DISTINCT product_id) FROM prices" if exact
+            else "SELECT COUNT(*) FROM product_latest_price"
+        ),
+    )
+
+    return {
+        'total_products': total_products,
+        'marketplace_stats': [dict(row) for row in marketplace_stats],
+        'total_prices': total_prices,
+        'total_prices_exact': exact,
+        'products_with_prices': products_with_prices
+    }
+
+
+async def _fetchval(db: AsyncDatabase, query: str, *args):
+    async with db.pool.acquire() as conn:
+        return await conn.fetchval(query, *args)
+
+
+async def _fetch(db: AsyncDatabase, query: str, *args) -> list:
+    async with db.pool.acquire() as conn:
+        return await conn.fetch(query, *args)
+
+
+async def count_prices(db: AsyncDatabase) -> int:
+    return await _fetchval(db, "SELECT COUNT(*) FROM prices")
+
+
+async def estimate_prices(db: AsyncDatabase) -> int:
+    # оценка по статистике планировщика, без чтения таблицы
+    try:
+        return await _fetchval(db, "SELECT approximate_row_count('prices')")
+    except asyncpg.PostgresError:
+        # без TimescaleDB: сумма reltuples по секциям (или по самой таблице)
+        return await _fetchval(
+            db,
             """
-            SELECT COUNT(DISTINCT product_id) FROM prices
+            SELECT COALESCE(sum(GREATEST(c.reltuples, 0)), 0)::bigint
+            FROM pg_partition_tree('prices') t
+            JOIN pg_class c ON c.oid = t.relid
+            WHERE t.isleaf
             """
         )
-        
-        return {
-            'total_products': total_products,
-            'marketplace_stats': [dict(row) for row in marketplace_stats],
-            'total_prices': total_prices,
-            'products_with_prices': products_with_prices
-        }
 
 
 async def get_recent_products(db: AsyncDatabase, limit: int = 10) -> list:
@@ -59,8 +102,38 @@ async def get_recent_products(db: AsyncDatabase, limit: int = 10) -> list:
         return [dict(row) for row in rows]
 
 
-async def get_products_with_price_history(db: AsyncDatabase, limit: int = 5) -> list:
+async def get_products_with_price_history(db: AsyncDatabase, limit: int = 5, exact: bool = False) -> list:
     async with db.pool.acquire() as conn:
+        if not exact and await conn.fetchval("SELECT to_regclass('prices_daily') IS NOT NULL"):
+            # дневные агрегаты вместо всей таблицы prices
+            rows = await conn.fetch(
+                """
+                SELECT
+                    p.id,
+                    p.name,
+                    p.brand,
+                    p.marketplace,
+                    d.price_count,
+                    d.min_price,
+                    d.max_price,
+                    lp.timestamp as last_price_update
+                FROM (
+                    SELECT product_id,
+                           SUM(samples) as price_count,
+                           MIN(low) as min_price,
+                           MAX(high) as max_price
+                    FROM prices_daily
+                    GROUP BY product_id
+                ) d
+                JOIN products p ON p.id = d.product_id
+                LEFT JOIN product_latest_price lp ON lp.product_id = d.product_id
+                ORDER BY price_count DESC, last_price_update DESC NULLS LAST
+                LIMIT $1
+                """,
+                limit
+            )
+            return [dict(row) for row in rows]
+
         rows = await conn.fetch(
             """
             SELECT 
@@ -84,7 +157,7 @@ async def get_products_with_price_history(db: AsyncDatabase, limit: int = 5) ->
         return [dict(row) for row in rows]
 
 
-async def get_products_updated_recently(db: AsyncDatabase, hours: int = 24) -> list:
+async def get_products_updated_recently(db: AsyncDatabase, hours: int = 24, limit: Optional[int] = None) -> list:
     async with db.pool.acquire() as conn:
         cutoff_time = datetime.now() - timedelta(hours=hours)
         rows = await conn.fetch(
@@ -100,12 +173,18 @@ async def get_products_updated_recently(db: AsyncDatabase, hours: int = 24) -> l
             FROM products
             WHERE last_scraped_at >= $1
             ORDER BY last_scraped_at DESC
+            LIMIT $2
             """,
-            cutoff_time
+            cutoff_time, limit
         )
         return [dict(row) for row in rows]
 
 
+async def count_products_updated_recently(db: AsyncDatabase, hours: int = 24) -> int:
+    cutoff_time = datetime.now() - timedelta(hours=hours)
+    return await _fetchval(db, "SELECT COUNT(*) FROM products WHERE last_scraped_at >= $1", cutoff_time)
+
+
 def print_separator(char='=', length=70):
     print(char * length)
 
@@ -116,10 +195,43 @@ def format_datetime(dt):
     return dt.strftime('%Y-%m-%d %H:%M:%S')
 
 
-async def main():
-    print_separator()
-    print("ПРОВЕРКА БАЗЫ ДАННЫХ PRICELENS")
-    print_separator()
+def json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+async def collect_report(db: AsyncDatabase, exact: bool = False) -> dict:
+    stats, recent, with_history, recent_updates, recent_updates_count = await asyncio.gather(
+        get_database_stats(db, exact=exact),
+        get_recent_products(db, limit=10),
+        get_products_with_price_history(db, limit=5, exact=exact),
+        get_products_updated_recently(db, hours=24, limit=5),
+        count_products_updated_recently(db, hours=24),
+    )
+    return {
+        'stats': stats,
+        'recent_products': recent,
+        'products_with_price_history': with_history,
+        'updated_recently': recent_updates,
+        'updated_recently_count': recent_updates_count,
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='PriceLens database health check')
+    parser.add_argument('--exact', action='store_true', help='exact counts over the whole prices table (slow)')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    return parser.parse_args()
+
+
+async def main(args: argparse.Namespace):
+    if not args.json:
+        print_separator()
+        print("ПРОВЕРКА БАЗЫ ДАННЫХ PRICELENS")
+        print_separator()
     
     db = AsyncDatabase(
         dbname="pricelens",
@@ -130,15 +242,20 @@ async def main():
     )
     
     try:
-        await db.connect()
-        
+        await db.connect(warm_cache=False)
+        report = await collect_report(db, exact=args.exact)
+
+        if args.json:
+            print(json.dumps(report, default=json_default, ensure_ascii=False, indent=2))
+            return
+
         print("ОБЩАЯ СТАТИСТИКА")
         print_separator('-')
-        stats = await get_database_stats(db)
+        stats = report['stats']
         
         print(f"Всего товаров: {stats['total_products']}")
         print(f"Товаров с ценами: {stats['products_with_prices']}")
-        print(f"Всего записей цен: {stats['total_prices']}")
+        print(f"Всего записей цен: {'' if stats['total_prices_exact'] else '~'}{stats['total_prices']}")
         print()
         
         if stats['marketplace_stats']:
@@ -149,7 +266,7 @@ async def main():
         
         print("ПОСЛЕДНИЕ ТОВАРЫ (ТОП 10)")
         print_separator('-')
-        recent = await get_recent_products(db, limit=10)
+        recent = report['recent_products']
         
         if recent:
             for i, product in enumerate(recent, 1):
@@ -165,7 +282,7 @@ async def main():
         
         print("ТОВАРЫ С ИСТОРИЕЙ ЦЕН (ТОП-5)")
         print_separator('-')
-        with_history = await get_products_with_price_history(db, limit=5)
+        with_history = report['products_with_price_history']
         
         if with_history:
             for i, product in enumerate(with_history, 1):
@@ -181,10 +298,11 @@ async def main():
         
         print("ОБНОВЛЕНО ЗА ПОСЛЕДНИЕ 24 ЧАСА")
         print_separator('-')
-        recent_updates = await get_products_updated_recently(db, hours=24)
+        recent_updates = report['updated_recently']
+        recent_updates_count = report['updated_recently_count']
         
         if recent_updates:
-            print(f"Найдено товаров: {len(recent_updates)}")
+            print(f"Найдено товаров: {recent_updates_count}")
             print()
             for i, product in enumerate(recent_updates[:5], 1):
                 print(f"{i}. {product['name']} ({product['size']})")
@@ -192,8 +310,8 @@ async def main():
                 print(f"   Обновлено: {format_datetime(product['last_scraped_at'])}")
                 print()
             
-            if len(recent_updates) > 5:
-                print(f"... и еще {len(recent_updates) - 5} товаров")
+            if recent_updates_count > 5:
+                print(f"... и еще {recent_updates_count - 5} товаров")
                 print()
         else:
             print("Нет товаров, обновленных за последние 24 часа")
@@ -206,10 +324,21 @@ async def main():
         
     except Exception as e:
         logger.error(f"Ошибка при проверке БД: {e}")
+        if args.json:
+            print(json.dumps({'error': str(e)}, ensure_ascii=False))
+            # мониторингу нужен ненулевой код выхода
+            sys.exit(1)
         print(f"\nОШИБКА: {e}\n")
     finally:
         await db.close()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    args = parse_args()
+    if args.json:
+        # RichHandler пишет в stdout, а там должен быть только JSON
+        for handler in logging.getLogger().handlers:
+            if isinstance(handler, RichHandler):
+                handler.console = Console(stderr=True)
+        logging.getLogger().setLevel(logging.WARNING)
+    asyncio.run(main(args))
\ No newline at end of file
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sys
+import zlib
+from dataclasses import asdict, fields
+from queue import Empty
+from time import monotonic
+
+from cache import PersistentCache
+from db.repository import AsyncDatabase
+from logger import get_logger
+from pipeline import CrawlPipeline, CrawlStats
+from test_parser import WBScraper
+
+logger = get_logger('crawl')
+
+
+def install_uvloop() -> bool:
+    try:
+        import uvloop
+    except ImportError:
+        return False
+    uvloop.install()
+    return True
+
+
+def shard_of(article: str, shards: int) -> int:
+    return zlib.crc32(article.encode()) % shards
+
+
+def shard_cache_path(path: str, index: int) -> str:
+    root, ext = os.path.splitext(path)
+    return f'{root}.{index}{ext}'
+
+
+def read_articles(path: str) -> list[str]:
+    stream = sys.stdin if path == '-' else open(path, encoding='utf-8')
+    try:
+        return [line.strip() for line in stream if line.strip()]
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+def scaled_limiter_configs(configs: dict[str, dict], share: int) -> dict[str, dict]:
+    # лимитеры живут внутри процесса, поэтому бюджет делим между воркерами
+    scaled = {}
+    for endpoint, options in configs.items():
+        options = dict(options)
+        options['limit'] = max(1, options['limit'] // share)
+        options['burst'] = max(1, options['burst'] // share)
+        scaled[endpoint] = options
+    return scaled
+
+
+async def crawl_shard(
+    index: int,
+    workers: int,
+    articles: list[str],
+    db_options: dict,
+    pipeline_options: dict,
+    progress: multiprocessing.Queue,
+) -> None:
+    # у каждого процесса свой файл кэша: SQLite плохо переносит параллельных
+    # писателей. Шард определяется crc32 артикула, так что при том же --workers
+    # процесс получает те же артикулы и свой же прогретый кэш.
+    # Дочерние процессы не вызывают atexit, поэтому кэш закрываем сами
+    cache = PersistentCache(shard_cache_path(WBScraper.cache_path, index))
+    # артикулы шарда пишет только этот процесс
+    db = AsyncDatabase(**db_options, cache=cache, exclusive_writer=True)
+    await db.connect()
+    try:
+        if index == 0:
+            # секции prices на текущий и следующие месяцы (без TimescaleDB)
+            await db.maintain_partitions()
+        scraper = WBScraper(db=db, cache=cache)
+        scraper.limiter_configs = scaled_limiter_configs(WBScraper.limiter_configs, workers)
+        pipeline = CrawlPipeline(
+            scraper, db,
+            on_progress=lambda stats: progress.put((index, asdict(stats), False)),
+            **pipeline_options
+        )
+        stats = await pipeline.run(scraper.session(), articles)
+        progress.put((index, asdict(stats), True))
+    finally:
+        await WBScraper.session_manager.close()
+        await db.close()
+        cache.close()
+
+
+def worker_main(
+    index: int,
+    workers: int,
+    articles: list[str],
+    db_options: dict,
+    pipeline_options: dict,
+    progress: multiprocessing.Queue,
+) -> None:
+    uvloop_enabled = install_uvloop()
+    logger.info(f"Worker {index}: {len(articles)} articles, uvloop={'on' if uvloop_enabled else 'off'}")
+    try:
+        asyncio.run(crawl_shard(index, workers, articles, db_options, pipeline_options, progress))
+    except Exception as e:
+        logger.error(f"Worker {index} failed: {e}")
+        progress.put((index, None, True))
+        raise
+
+
+def report(stats_by_worker: dict[int, dict], total_articles: int) -> None:
+    totals = CrawlStats()
+    for stats in stats_by_worker.values():
+        for field in fields(CrawlStats):
+            setattr(totals, field.name, getattr(totals, field.name) + stats[field.name])
+    logger.info(
+        f"Progress: {totals.articles}/{total_articles} articles, {totals.saved} saved, "
+        f"{totals.failed_batches} failed batches"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Multi-process Wildberries crawler')
+    parser.add_argument('articles', help="file with one article per line, '-' for stdin")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--db-name', default='pricelens')
+    parser.add_argument('--db-user', default='postgres')
+    parser.add_argument('--db-password', default='postgres')
+    parser.add_argument('--db-host', default='localhost')
+    parser.add_argument('--db-port', type=int, default=5432)
+    parser.add_argument('--fetch-workers', type=int, default=8)
+    parser.add_argument('--flush-rows', type=int, default=2000)
+    parser.add_argument('--report-interval', type=float, default=5.0)
+    args = parser.parse_args()
+
+    articles = read_articles(args.articles)
+    workers = max(1, min(args.workers, len(articles)))
+    shards: list[list[str]] = [[] for _ in range(workers)]
+    for article in articles:
+        shards[shard_of(article, workers)].append(article)
+
+    db_options = dict(
+        dbname=args.db_name,
+        user=args.db_user,
+        password=args.db_password,
+        host=args.db_host,
+        port=args.db_port,
+    )
+    pipeline_options = dict(fetch_workers=args.fetch_workers, flush_rows=args.flush_rows)
+
+    progress: multiprocessing.Queue = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(
+            target=worker_main,
+            args=(index, workers, shard, db_options, pipeline_options, progress),
+            name=f'crawler-{index}',
+        )
+        for index, shard in enumerate(shards)
+    ]
+    for process in processes:
+        process.start()
+    logger.info(f"Started {workers} workers for {len(articles)} articles")
+
+    stats_by_worker: dict[int, dict] = {}
+    finished: set[int] = set()
+    reported_at = monotonic()
+    while len(finished) < workers:
+        try:
+            index, stats, done = progress.get(timeout=args.report_interval)
+            if stats is not None:
+                stats_by_worker[index] = stats
+            if done:
+                finished.add(index)
+        except Empty:
+            if not any(process.is_alive() for process in processes):
+                break
+
+        if monotonic() - reported_at >= args.report_interval:
+            report(stats_by_worker, len(articles))
+            reported_at = monotonic()
+
+    for process in processes:
+        process.join()
+    report(stats_by_worker, len(articles))
+
+    failed = [process.name for process in processes if process.exitcode != 0]
+    if failed:
+        logger.error(f"Workers failed: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,14 @@
+from datetime import timedelta
+from typing import Optional
+
 import psycopg2
 
+# (представление, размер бакета, start_offset, end_offset, период обновления)
+PRICE_ROLLUPS = (
+    ('prices_hourly', '1 hour', timedelta(days=3), timedelta(hours=1), timedelta(minutes=30)),
+    ('prices_daily', '1 day', timedelta(days=7), timedelta(days=1), timedelta(hours=1)),
+)
+
 
 class Database:
     def __init__(
@@ -9,12 +18,23 @@ class Database:
         password: str,
         host: str = "localhost",
         port: int = 5432,
+        compress_after: timedelta = timedelta(days=7),
+        drop_after: Optional[timedelta] = None,
+        partition_months_ahead: int = 3,
     ) -> None:
+        # сырые цены можно удалять только после того, как их свернули в rollup'ы
+        refresh_window = max(start_offset for _, _, start_offset, _, _ in PRICE_ROLLUPS)
+        if drop_after is not None and drop_after <= refresh_window:
+            raise ValueError(f"drop_after must be longer than {refresh_window}, got {drop_after}")
+
         self.dbname = dbname
         self.user = user
         self.password = password
         self.host = host
         self.port = port
+        self.compress_after = compress_after
+        self.drop_after = drop_after
+        self.partition_months_ahead = partition_months_ahead
 
         self.conn: psycopg2.extensions.connection | None = None
 
@@ -66,10 +86,28 @@ class Database:
                 timescaledb_available = True
             except Exception as e:
                 print(f"Warning: TimescaleDB extension not available: {e}")
-                print("Continuing without TimescaleDB (prices table will be regular table)")
+                print("Continuing without TimescaleDB (prices will be partitioned by month)")
                 self.conn.rollback()
                 timescaledb_available = False
 
+            # Таблица pricelens_instance: случайный токен базы, меняется при её
+            # пересоздании (к нему привязан кэш id товаров на диске)
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS pricelens_instance (
+                    id    BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+                    token TEXT NOT NULL
+                )
+                """
+            )
+            cur.execute(
+                """
+                INSERT INTO pricelens_instance (token)
+                VALUES (md5(random()::text || clock_timestamp()::text))
+                ON CONFLICT (id) DO NOTHING
+                """
+            )
+
             # Таблица users
             cur.execute(
                 """
@@ -95,11 +133,20 @@ class Database:
                     size            TEXT,
                     quantity        INTEGER,
                     pics            INTEGER,
-                    last_scraped_at TIMESTAMPTZ
+                    last_scraped_at TIMESTAMPTZ,
+                    price_seen_at   TIMESTAMPTZ
                 )
                 """
             )
 
+            # Для баз, созданных до появления колонки
+            cur.execute(
+                """
+                ALTER TABLE products
+                ADD COLUMN IF NOT EXISTS price_seen_at TIMESTAMPTZ
+                """
+            )
+
             cur.execute(
                 """
                 DO $$
@@ -151,18 +198,50 @@ class Database:
                 """
             )
 
-            # Таблица prices (hypertable)
+            # Таблица scrape_jobs (очередь заданий для воркеров на разных машинах)
             cur.execute(
                 """
-                CREATE TABLE IF NOT EXISTS prices (
-                    product_id  BIGINT NOT NULL REFERENCES products(id) ON DELETE CASCADE,
-                    timestamp   TIMESTAMPTZ NOT NULL,
-                    price       NUMERIC(12,2) NOT NULL,
-                    PRIMARY KEY (product_id, timestamp)
+                CREATE TABLE IF NOT EXISTS scrape_jobs (
+                    id           BIGSERIAL PRIMARY KEY,
+                    marketplace  TEXT NOT NULL,
+                    internal_id  BIGINT NOT NULL,
+                    status       TEXT NOT NULL DEFAULT 'pending',
+                    attempts     INTEGER NOT NULL DEFAULT 0,
+                    max_attempts INTEGER NOT NULL DEFAULT 5,
+                    run_at       TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    locked_by    TEXT,
+                    locked_until TIMESTAMPTZ,
+                    last_error   TEXT,
+                    finished_at  TIMESTAMPTZ,
+                    UNIQUE (marketplace, internal_id)
                 )
                 """
             )
 
+            # Индекс для выборки заданий к выполнению
+            cur.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_scrape_jobs_claim
+                ON scrape_jobs (run_at)
+                WHERE status IN ('pending', 'running')
+                """
+            )
+
+            # Таблица prices (hypertable, без TimescaleDB - секционированная по месяцам)
+            if not timescaledb_available:
+                self._init_price_partitions(cur)
+            else:
+                cur.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS prices (
+                        product_id  BIGINT NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+                        timestamp   TIMESTAMPTZ NOT NULL,
+                        price       NUMERIC(12,2) NOT NULL,
+                        PRIMARY KEY (product_id, timestamp)
+                    )
+                    """
+                )
+
             # Превращаем prices в hypertable
             if timescaledb_available:
                 try:
@@ -179,4 +258,288 @@ class Database:
                 except Exception as e:
                     print(f"Warning: Could not create hypertable: {e}")
 
+            # Таблица product_latest_price (последняя цена товара, ведётся при записи цен)
+            cur.execute("SELECT to_regclass('product_latest_price') IS NULL")
+            backfill_latest = cur.fetchone()[0]
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS product_latest_price (
+                    product_id  BIGINT PRIMARY KEY REFERENCES products(id) ON DELETE CASCADE,
+                    price       NUMERIC(12,2) NOT NULL,
+                    timestamp   TIMESTAMPTZ NOT NULL
+                )
+                """
+            )
+            if backfill_latest:
+                cur.execute(
+                    """
+                    INSERT INTO product_latest_price (product_id, price, timestamp)
+                    SELECT DISTINCT ON (product_id) product_id, price, timestamp
+                    FROM prices
+                    ORDER BY product_id, timestamp DESC
+                    """
+                )
+
         self.conn.commit()
+
+        if timescaledb_available:
+            rollups_ready = self._init_price_rollups()
+            self._init_price_policies(rollups_ready)
+
+    def _init_price_partitions(self, cur) -> None:
+        cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('prices')")
+        row = cur.fetchone()
+        if row is None:
+            cur.execute(
+                """
+                CREATE TABLE prices (
+                    product_id  BIGINT NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+                    timestamp   TIMESTAMPTZ NOT NULL,
+                    price       NUMERIC(12,2) NOT NULL,
+                    PRIMARY KEY (product_id, timestamp)
+                ) PARTITION BY RANGE (timestamp)
+                """
+            )
+            # сюда попадают цены за месяцы, для которых ещё нет секции
+            cur.execute("CREATE TABLE prices_default PARTITION OF prices DEFAULT")
+            print("Created prices partitioned by month")
+        elif row[0] != 'p':
+            print("Warning: prices already exists as a regular table, partitioning skipped")
+            return
+
+        # Секция prices_YYYY_MM за месяц (UTC); строки этого месяца
+        # переносятся из prices_default до ATTACH
+        cur.execute(
+            """
+            CREATE OR REPLACE FUNCTION pricelens_ensure_price_partition(month_start DATE)
+            RETURNS TEXT
+            LANGUAGE plpgsql AS $fn$
+            DECLARE
+                partition_name TEXT := 'prices_' || to_char(month_start, 'YYYY_MM');
+                next_month     DATE := (month_start + INTERVAL '1 month')::date;
+                range_start    TIMESTAMPTZ := make_timestamptz(
+                    extract(year FROM month_start)::int, extract(month FROM month_start)::int, 1, 0, 0, 0, 'UTC'
+                );
+                range_end      TIMESTAMPTZ := make_timestamptz(
+                    extract(year FROM next_month)::int, extract(month FROM next_month)::int, 1, 0, 0, 0, 'UTC'
+                );
+            BEGIN
+                PERFORM pg_advisory_xact_lock(hashtext('pricelens_price_partitions'));
+                IF to_regclass(partition_name) IS NOT NULL THEN
+                    RETURN partition_name;
+                END IF;
+
+                LOCK TABLE prices_default IN ACCESS EXCLUSIVE MODE;
+                EXECUTE format(
+                    'CREATE TABLE %I (LIKE prices INCLUDING DEFAULTS INCLUDING CONSTRAINTS)',
+                    partition_name
+                );
+                EXECUTE format(
+                    'WITH moved AS ('
+                    '    DELETE FROM prices_default WHERE timestamp >= %L AND timestamp < %L'
+                    '    RETURNING product_id, timestamp, price'
+                    ') INSERT INTO %I (product_id, timestamp, price) SELECT * FROM moved',
+                    range_start, range_end, partition_name
+                );
+                EXECUTE format(
+                    'ALTER TABLE prices ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                    partition_name, range_start, range_end
+                );
+                RETURN partition_name;
+            END
+            $fn$
+            """
+        )
+
+        # Отсоединяет и удаляет секции, целиком старше keep
+        cur.execute(
+            """
+            CREATE OR REPLACE FUNCTION pricelens_drop_expired_price_partitions(keep INTERVAL)
+            RETURNS INTEGER
+            LANGUAGE plpgsql AS $fn$
+            DECLARE
+                expired TEXT;
+                dropped INTEGER := 0;
+            BEGIN
+                PERFORM pg_advisory_xact_lock(hashtext('pricelens_price_partitions'));
+                FOR expired IN
+                    SELECT c.relname
+                    FROM pg_inherits i
+                    JOIN pg_class c ON c.oid = i.inhrelid
+                    WHERE i.inhparent = 'prices'::regclass
+                      AND c.relname ~ '^prices_[0-9]{4}_[0-9]{2}$'
+                      AND (to_date(substring(c.relname FROM 8), 'YYYY_MM') + INTERVAL '1 month')
+                          AT TIME ZONE 'UTC' <= now() - keep
+                LOOP
+                    EXECUTE format('ALTER TABLE prices DETACH PARTITION %I', expired);
+                    EXECUTE format('DROP TABLE %I', expired);
+                    dropped := dropped + 1;
+                END LOOP;
+
+                DELETE FROM prices_default WHERE timestamp < now() - keep;
+                RETURN dropped;
+            END
+            $fn$
+            """
+        )
+
+        # Секции на текущий и months_ahead следующих месяцев, плюс на месяцы,
+        # чьи строки уже попали в prices_default; возвращает число удалённых секций
+        cur.execute(
+            """
+            CREATE OR REPLACE FUNCTION pricelens_maintain_price_partitions(
+                months_ahead INTEGER,
+                keep INTERVAL DEFAULT NULL
+            )
+            RETURNS INTEGER
+            LANGUAGE plpgsql AS $fn$
+            DECLARE
+                month_start DATE;
+            BEGIN
+                FOR month_start IN
+                    SELECT generate_series(
+                        date_trunc('month', now() AT TIME ZONE 'UTC'),
+                        date_trunc('month', now() AT TIME ZONE 'UTC') + make_interval(months => months_ahead),
+                        INTERVAL '1 month'
+                    )::date
+                    UNION
+                    SELECT DISTINCT date_trunc('month', timestamp AT TIME ZONE 'UTC')::date
+                    FROM prices_default
+                LOOP
+                    PERFORM pricelens_ensure_price_partition(month_start);
+                END LOOP;
+
+                IF keep IS NULL THEN
+                    RETURN 0;
+                END IF;
+                RETURN pricelens_drop_expired_price_partitions(keep);
+            END
+            $fn$
+            """
+        )
+
+        cur.execute(
+            "SELECT pricelens_maintain_price_partitions(%s, %s)",
+            (self.partition_months_ahead, self.drop_after)
+        )
+
+    def _init_price_rollups(self) -> bool:
+        # continuous aggregate нельзя создать внутри транзакции
+        self.conn.autocommit = True
+        try:
+            with self.conn.cursor() as cur:
+                for view, bucket, start_offset, end_offset, schedule in PRICE_ROLLUPS:
+                    cur.execute("SELECT to_regclass(%s) IS NOT NULL", (view,))
+                    existed = cur.fetchone()[0]
+                    cur.execute(
+                        f"""
+                        CREATE MATERIALIZED VIEW IF NOT EXISTS {view}
+                        WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+                        SELECT product_id,
+                               time_bucket(INTERVAL '{bucket}', timestamp) AS bucket,
+                               first(price, timestamp) AS open,
+                               max(price)              AS high,
+                               min(price)              AS low,
+                               last(price, timestamp)  AS close,
+                               avg(price)              AS avg,
+                               count(*)                AS samples
+                        FROM prices
+                        GROUP BY product_id, bucket
+                        WITH NO DATA
+                        """
+                    )
+                    cur.execute(
+                        """
+                        SELECT add_continuous_aggregate_policy(
+                            %s,
+                            start_offset => %s::interval,
+                            end_offset => %s::interval,
+                            schedule_interval => %s::interval,
+                            if_not_exists => TRUE
+                        )
+                        """,
+                        (view, start_offset, end_offset, schedule)
+                    )
+                    if not existed:
+                        # политика обновляет только последние start_offset, а
+                        # real-time агрегация видит лишь данные новее watermark,
+                        # поэтому уже накопленную историю материализуем сразу
+                        cur.execute(
+                            "CALL refresh_continuous_aggregate(%s, NULL, now() - %s::interval)",
+                            (view, end_offset)
+                        )
+                        print(f"Materialized existing history into {view}")
+                    elif self.drop_after is not None:
+                        # всё, что удалит retention, должно быть свёрнуто, включая
+                        # историю, не попавшую в окно политики (старые базы, догрузки)
+                        cur.execute(
+                            "CALL refresh_continuous_aggregate(%s, NULL, now() - %s::interval)",
+                            (view, self.drop_after)
+                        )
+            print("TimescaleDB continuous aggregates ready for prices")
+            return True
+        except Exception as e:
+            print(f"Warning: Could not create continuous aggregates: {e}")
+            return False
+        finally:
+            self.conn.autocommit = False
+
+    def _init_price_policies(self, rollups_ready: bool) -> None:
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute(
+                    """
+                    SELECT compression_enabled
+                    FROM timescaledb_information.hypertables
+                    WHERE hypertable_name = 'prices'
+                    """
+                )
+                row = cur.fetchone()
+                if row is None:
+                    print("Warning: prices is not a hypertable, skipping compression and retention")
+                    return
+
+                if not row[0]:
+                    # в одном сегменте лежит история одного товара, отсортированная
+                    # так же, как её читает get_product_price_history
+                    cur.execute(
+                        """
+                        ALTER TABLE prices SET (
+                            timescaledb.compress,
+                            timescaledb.compress_segmentby = 'product_id',
+                            timescaledb.compress_orderby = 'timestamp DESC'
+                        )
+                        """
+                    )
+
+                # политики пересоздаём, чтобы изменённые настройки вступили в силу
+                cur.execute("SELECT remove_compression_policy('prices', if_exists => TRUE)")
+                cur.execute(
+                    """
+                    SELECT add_compression_policy(
+                        'prices',
+                        compress_after => %s::interval
+                    )
+                    """,
+                    (self.compress_after,)
+                )
+
+                cur.execute("SELECT remove_retention_policy('prices', if_exists => TRUE)")
+                if self.drop_after is not None and not rollups_ready:
+                    # без свёрнутой истории retention удалил бы данные безвозвратно
+                    print("Warning: continuous aggregates are not ready, retention policy not installed")
+                elif self.drop_after is not None:
+                    cur.execute(
+                        """
+                        SELECT add_retention_policy(
+                            'prices',
+                            drop_after => %s::interval
+                        )
+                        """,
+                        (self.drop_after,)
+                    )
+            self.conn.commit()
+            print("TimescaleDB compression and retention policies configured for prices")
+        except Exception as e:
+            print(f"Warning: Could not configure compression and retention: {e}")
+            self.conn.rollback()
@@ -1,10 +1,35 @@
+import asyncio
+import hashlib
 import asyncpg
-from typing import Optional, List, Dict, Any
-from datetime import datetime
+from typing import Optional, List, Dict, Any, AsyncIterator, Iterable, Tuple
+from datetime import datetime, timedelta, timezone
+from cache import LRUCache, PersistentCache
+from records import UnchangedProduct
+from series import PriceSeriesBatch
 from logger import get_logger
 
 logger = get_logger('db.repository')
 
+PRICE_MODES = ('full', 'changes')
+
+PRODUCT_FIELDS = ('name', 'brand', 'brand_id', 'image_url', 'quantity', 'pics')
+
+# continuous aggregates из db/database.py, от крупных бакетов к мелким
+PRICE_ROLLUP_VIEWS = (
+    (timedelta(days=1), 'prices_daily'),
+    (timedelta(hours=1), 'prices_hourly'),
+)
+
+BUCKET_FIELDS = ('open', 'high', 'low', 'close', 'avg')
+
+# то же начало отсчёта, что у time_bucket в TimescaleDB
+BUCKET_ORIGIN = datetime(2000, 1, 3, tzinfo=timezone.utc)
+
+
+def content_hash(values: Tuple[Any, ...]) -> int:
+    digest = hashlib.blake2b(repr(values).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
 
 class AsyncDatabase:
     
@@ -15,15 +40,37 @@ class AsyncDatabase:
         password: str,
         host: str = "localhost",
         port: int = 5432,
+        identity_cache_size: int = 100_000,
+        scraped_flush_size: int = 10_000,
+        price_mode: str = 'full',
+        cache: Optional[PersistentCache] = None,
+        exclusive_writer: bool = False,
     ) -> None:
+        if price_mode not in PRICE_MODES:
+            raise ValueError(f"price_mode must be one of {PRICE_MODES}, got {price_mode!r}")
+
         self.dbname = dbname
         self.user = user
         self.password = password
         self.host = host
         self.port = port
         self.pool: Optional[asyncpg.Pool] = None
+        self.scraped_flush_size = scraped_flush_size
+        self.price_mode = price_mode
+        # кэш на диске подключается в connect(), когда известен токен базы
+        self._cache = cache
+        # пропуск записи по хэшу метаданных верен, только пока товары пишет
+        # один этот процесс: иначе кэшированный хэш может отставать от базы,
+        # и новое значение другого воркера останется поверх наших данных
+        self.exclusive_writer = exclusive_writer
+        self._product_ids: LRUCache[Tuple[str, int, Optional[str]], int] = LRUCache(identity_cache_size)
+        self._product_hashes: LRUCache[int, int] = LRUCache(identity_cache_size)
+        self._scraped_ids: set[int] = set()
+        self._price_seen_ids: set[int] = set()
+        self._scraped_at: Optional[datetime] = None
+        self._rollup_views: Optional[List[Tuple[timedelta, str]]] = None
     
-    async def connect(self) -> None:
+    async def connect(self, warm_cache: bool = True) -> None:
         try:
             self.pool = await asyncpg.create_pool(
                 database=self.dbname,
@@ -38,9 +85,93 @@ class AsyncDatabase:
         except Exception as e:
             logger.error(f"Failed to connect to database: {e}")
             raise
+
+        if self._cache is not None:
+            await self._attach_persistent_cache()
+        if warm_cache:
+            await self.warm_identity_cache()
+
+    async def _attach_persistent_cache(self) -> None:
+        # id товаров из BIGSERIAL после пересоздания базы начинаются заново, поэтому
+        # кэш на диске привязан не к адресу, а к токену, который _init_schema
+        # записывает при создании схемы
+        async with self.pool.acquire() as conn:
+            try:
+                token = await conn.fetchval("SELECT token FROM pricelens_instance")
+            except asyncpg.UndefinedTableError:
+                token = None
+        if token is None:
+            logger.warning("pricelens_instance is missing, product ids are cached in memory only")
+            return
+
+        self._product_ids.backing = self._cache.namespace(f'product_ids:{token}')
+        self._product_hashes.backing = self._cache.namespace(f'product_hashes:{token}')
+
+    async def warm_identity_cache(self) -> int:
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(
+                """
+                SELECT id, marketplace, internal_id, size,
+                       name, brand, brand_id, image_url, quantity, pics
+                FROM products
+                ORDER BY last_scraped_at DESC NULLS LAST
+                LIMIT $1
+                """,
+                self._product_ids.max_size
+            )
+
+        # самые свежие товары кладём последними, чтобы они вытеснялись позже;
+        # на диск не пишем - эти значения и так только что прочитаны из БД
+        rows = rows[::-1]
+        self._product_ids.warm(
+            ((row['marketplace'], row['internal_id'], row['size']), row['id']) for row in rows
+        )
+        self._product_hashes.warm(
+            (row['id'], content_hash(tuple(row[field] for field in PRODUCT_FIELDS))) for row in rows
+        )
+        logger.info(f"Warmed product identity cache with {len(rows)} products")
+        return len(rows)
+
+    def identity_cache_stats(self) -> Dict[str, Any]:
+        return self._product_ids.stats()
     
+    def _mark_scraped(self, product_ids: Iterable[int], price_seen_ids: Iterable[int] = ()) -> None:
+        self._scraped_ids.update(product_ids)
+        self._price_seen_ids.update(price_seen_ids)
+        self._scraped_at = datetime.now()
+
+    async def flush_scraped_at(self) -> int:
+        if not self._scraped_ids:
+            return 0
+
+        product_ids = list(self._scraped_ids)
+        price_seen_ids = list(self._price_seen_ids)
+        scraped_at = self._scraped_at
+        self._scraped_ids.clear()
+        self._price_seen_ids.clear()
+        async with self.pool.acquire() as conn:
+            await conn.execute(
+                """
+                UPDATE products
+                SET last_scraped_at = $2,
+                    price_seen_at = CASE
+                        WHEN id = ANY($3::bigint[]) THEN $2
+                        ELSE price_seen_at
+                    END
+                WHERE id = ANY($1::bigint[])
+                """,
+                product_ids, scraped_at, price_seen_ids
+            )
+        logger.debug(f"Updated last_scraped_at for {len(product_ids)} products")
+        return len(product_ids)
+
+    async def _maybe_flush_scraped_at(self) -> None:
+        if len(self._scraped_ids) >= self.scraped_flush_size:
+            await self.flush_scraped_at()
+
     async def close(self) -> None:
         if self.pool:
+            await self.flush_scraped_at()
             await self.pool.close()
             logger.info("Database connection pool closed")
     
@@ -56,33 +187,47 @@ class AsyncDatabase:
         quantity: Optional[int] = None,
         pics: Optional[int] = None,
     ) -> int:
+        key = (marketplace, internal_id, size)
+        values = (name, brand, brand_id, image_url, quantity, pics)
+        digest = content_hash(values)
+
+        product_id = self._product_ids.get(key)
+        if (self.exclusive_writer and product_id is not None
+                and self._product_hashes.peek(product_id) == digest):
+            self._mark_scraped([product_id])
+            await self._maybe_flush_scraped_at()
+            return product_id
+
         async with self.pool.acquire() as conn:
             row = await conn.fetchrow(
                 """
-                SELECT id FROM products
+                SELECT id, name, brand, brand_id, image_url, quantity, pics
+                FROM products
                 WHERE internal_id = $1 AND marketplace = $2 AND size = $3
                 """,
                 internal_id, marketplace, size
             )
-            
+
             if row:
                 product_id = row['id']
-                await conn.execute(
-                    """
-                    UPDATE products
-                    SET name = $1,
-                        brand = $2,
-                        brand_id = $3,
-                        image_url = $4,
-                        quantity = $5,
-                        pics = $6,
-                        last_scraped_at = $7
-                    WHERE id = $8
-                    """,
-                    name, brand, brand_id, image_url, quantity, pics,
-                    datetime.now(), product_id
-                )
-                logger.debug(f"Updated product {product_id} ({marketplace}:{internal_id}:{size})")
+                changed = {
+                    field: value
+                    for field, value in zip(PRODUCT_FIELDS, values)
+                    if row[field] != value
+                }
+                if changed:
+                    assignments = ', '.join(
+                        f'{field} = ${num}' for num, field in enumerate(changed, start=2)
+                    )
+                    await conn.execute(
+                        f"UPDATE products SET {assignments} WHERE id = $1",
+                        product_id, *changed.values()
+                    )
+                    logger.debug(
+                        f"Updated {', '.join(changed)} of product {product_id} "
+                        f"({marketplace}:{internal_id}:{size})"
+                    )
+                self._mark_scraped([product_id])
             else:
                 row = await conn.fetchrow(
                     """
@@ -98,9 +243,12 @@ class AsyncDatabase:
                 )
                 product_id = row['id']
                 logger.info(f"Created new product {product_id} ({marketplace}:{internal_id}:{size})")
-            
-            return product_id
-    
+
+        self._product_ids.put(key, product_id)
+        self._product_hashes.put(product_id, digest)
+        await self._maybe_flush_scraped_at()
+        return product_id
+
     async def insert_price(
         self,
         product_id: int,
@@ -111,18 +259,149 @@ class AsyncDatabase:
             timestamp = datetime.now()
         
         async with self.pool.acquire() as conn:
-            await conn.execute(
-                """
-                INSERT INTO prices (product_id, timestamp, price)
-                VALUES ($1, $2, $3)
-                ON CONFLICT (product_id, timestamp) DO UPDATE
-                SET price = EXCLUDED.price
-                """,
-                product_id, timestamp, price
-            )
+            async with conn.transaction():
+                await conn.execute(
+                    """
+                    INSERT INTO prices (product_id, timestamp, price)
+                    VALUES ($1, $2, $3)
+                    ON CONFLICT (product_id, timestamp) DO UPDATE
+                    SET price = EXCLUDED.price
+                    """,
+                    product_id, timestamp, price
+                )
+                await self._update_latest_prices(conn, [(product_id, timestamp, price)])
             logger.debug(f"Inserted price {price} for product {product_id} at {timestamp}")
     
+    async def copy_prices(
+        self,
+        rows: AsyncIterator[Tuple[int, datetime, float]],
+        chunk_size: int = 50_000,
+        max_pending_chunks: int = 2
+    ) -> int:
+        # Чтение источника и запись в БД идут параллельно; в памяти
+        # одновременно не больше (max_pending_chunks + 2) * chunk_size строк.
+        chunks: asyncio.Queue = asyncio.Queue(maxsize=max_pending_chunks)
+
+        async def produce() -> None:
+            # при отмене (запись в БД упала) sentinel не нужен: его уже
+            # некому прочитать, и put на полной очереди повис бы навсегда
+            try:
+                chunk = []
+                async for row in rows:
+                    chunk.append(row)
+                    if len(chunk) >= chunk_size:
+                        await chunks.put(chunk)
+                        chunk = []
+                if chunk:
+                    await chunks.put(chunk)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                await chunks.put(None)
+                raise
+            await chunks.put(None)
+
+        producer = asyncio.create_task(produce())
+        total = 0
+        first: Optional[datetime] = None
+        last: Optional[datetime] = None
+        try:
+            async with self.pool.acquire() as conn:
+                await conn.execute(
+                    """
+                    CREATE TEMP TABLE IF NOT EXISTS prices_staging (
+                        product_id  BIGINT NOT NULL,
+                        timestamp   TIMESTAMPTZ NOT NULL,
+                        price       NUMERIC(12,2) NOT NULL
+                    ) ON COMMIT DELETE ROWS
+                    """
+                )
+                while True:
+                    chunk = await chunks.get()
+                    if chunk is None:
+                        break
+                    async with conn.transaction():
+                        await conn.copy_records_to_table(
+                            'prices_staging',
+                            records=chunk,
+                            columns=['product_id', 'timestamp', 'price']
+                        )
+                        await conn.execute(
+                            """
+                            INSERT INTO prices (product_id, timestamp, price)
+                            SELECT DISTINCT ON (product_id, timestamp)
+                                   product_id, timestamp, price
+                            FROM prices_staging
+                            ORDER BY product_id, timestamp
+                            ON CONFLICT (product_id, timestamp) DO UPDATE
+                            SET price = EXCLUDED.price
+                            """
+                        )
+                        await conn.execute(
+                            """
+                            INSERT INTO product_latest_price AS latest (product_id, price, timestamp)
+                            SELECT DISTINCT ON (product_id)
+                                   product_id, price, timestamp
+                            FROM prices_staging
+                            ORDER BY product_id, timestamp DESC
+                            ON CONFLICT (product_id) DO UPDATE
+                            SET price = EXCLUDED.price,
+                                timestamp = EXCLUDED.timestamp
+                            WHERE latest.timestamp <= EXCLUDED.timestamp
+                            """
+                        )
+                    total += len(chunk)
+                    timestamps = [row[1] for row in chunk]
+                    first = min(timestamps) if first is None else min(first, *timestamps)
+                    last = max(timestamps) if last is None else max(last, *timestamps)
+                    logger.debug(f"Copied {len(chunk)} prices ({total} total)")
+            await producer
+        finally:
+            if not producer.done():
+                producer.cancel()
+            # дожидаемся отмены, чтобы задача не пережила вызов; её ошибка
+            # (если есть) уже всплыла из await producer выше
+            await asyncio.gather(producer, return_exceptions=True)
+
+        logger.info(f"Copied {total} prices into prices")
+        if total:
+            # исторические данные старше окна политик сами в rollup'ы не попадут
+            await self.refresh_price_rollups(first, last)
+        return total
+
+    async def refresh_price_rollups(self, since: datetime, until: datetime) -> None:
+        async with self.pool.acquire() as conn:
+            for size, view in await self._available_rollups(conn):
+                # окно расширяем на бакет в обе стороны, иначе крайние неполные
+                # бакеты не пересчитаются
+                start = (since if since.tzinfo else since.replace(tzinfo=timezone.utc)) - size
+                end = (until if until.tzinfo else until.replace(tzinfo=timezone.utc)) + size
+                # refresh_continuous_aggregate нельзя вызывать в транзакции, а
+                # подготовленный запрос asyncpg выполняется в неявной, поэтому
+                # отправляем простым запросом без параметров
+                await conn.execute(
+                    f"CALL refresh_continuous_aggregate('{view}', "
+                    f"'{start.isoformat()}'::timestamptz, '{end.isoformat()}'::timestamptz)"
+                )
+                logger.info(f"Refreshed {view} for {start} .. {end}")
+
+    def _evict_products(self, products: List[Dict[str, Any]]) -> None:
+        for product_data in products:
+            key = (product_data['marketplace'], product_data['internal_id'], product_data.get('size'))
+            product_id = self._product_ids.pop(key)
+            if product_id is not None:
+                self._product_hashes.pop(product_id)
+
     async def save_parsed_product(self, product_data: Dict[str, Any]) -> int:
+        try:
+            return await self._save_parsed_product(product_data)
+        except asyncpg.ForeignKeyViolationError as e:
+            # id из кэша (в том числе с диска) указывает на удалённый товар
+            logger.warning(f"Stale cached id for product {product_data.get('internal_id')}, retrying: {e}")
+            self._evict_products([product_data])
+            return await self._save_parsed_product(product_data)
+
+    async def _save_parsed_product(self, product_data: Dict[str, Any]) -> int:
         product_id = await self.get_or_create_product(
             internal_id=product_data['internal_id'],
             marketplace=product_data['marketplace'],
@@ -137,40 +416,801 @@ class AsyncDatabase:
         
         price = product_data.get('price', 0.0)
         if price > 0:
-            await self.insert_price(product_id, price)
+            if self.price_mode == 'changes':
+                async with self.pool.acquire() as conn:
+                    async with conn.transaction():
+                        changed = await self._changed_prices(conn, [(product_id, datetime.now(), price)])
+                        await self._insert_prices(conn, changed)
+                self._mark_scraped([product_id], [product_id])
+            else:
+                await self.insert_price(product_id, price)
         
         return product_id
     
-    async def save_parsed_products(self, products: List[Dict[str, Any]]) -> List[int]:
-        product_ids = []
-        for product_data in products:
+    async def save_parsed_products(
+        self,
+        products: List[Dict[str, Any]],
+        job_ids: Optional[List[int]] = None,
+        worker_id: Optional[str] = None
+    ) -> List[int]:
+        unchanged = [product for product in products if isinstance(product, UnchangedProduct)]
+        if unchanged:
+            products = [product for product in products if not isinstance(product, UnchangedProduct)]
+            await self.touch_products(unchanged)
+
+        if not products:
+            if job_ids:
+                await self.complete_scrape_jobs(worker_id, job_ids)
+            return []
+
+        try:
             try:
-                product_id = await self.save_parsed_product(product_data)
-                product_ids.append(product_id)
-            except Exception as e:
-                logger.error(f"Failed to save product {product_data.get('internal_id')}: {e}")
-        
+                product_ids = await self.save_products_bulk(products, job_ids=job_ids, worker_id=worker_id)
+            except asyncpg.ForeignKeyViolationError as e:
+                # id из кэша (в том числе с диска) указывает на удалённый товар
+                logger.warning(f"Stale cached product ids in a batch of {len(products)}, retrying: {e}")
+                self._evict_products(products)
+                product_ids = await self.save_products_bulk(products, job_ids=job_ids, worker_id=worker_id)
+        except asyncpg.PostgresError as e:
+            logger.warning(f"Bulk save of {len(products)} products failed, saving one by one: {e}")
+            product_ids = []
+            failed: set[Tuple[str, int]] = set()
+            for product_data in products:
+                try:
+                    product_id = await self.save_parsed_product(product_data)
+                    product_ids.append(product_id)
+                except Exception as error:
+                    logger.error(f"Failed to save product {product_data.get('internal_id')}: {error}")
+                    failed.add((product_data['marketplace'], product_data['internal_id']))
+            if job_ids:
+                # закрываем только задания, чьи товары записались целиком;
+                # остальные вызывающий код вернёт в очередь через fail_scrape_jobs
+                await self.complete_scrape_jobs(worker_id, job_ids, skip=failed)
+                if failed:
+                    raise RuntimeError(f"Failed to save {len(failed)} articles after bulk save error: {e}")
+
         logger.info(f"Saved {len(product_ids)} products to database")
         return product_ids
-    
+
+    async def touch_products(self, products: List[UnchangedProduct]) -> None:
+        by_marketplace: Dict[str, List[int]] = {}
+        for product in products:
+            by_marketplace.setdefault(product.marketplace, []).append(product.internal_id)
+
+        scraped_at = datetime.now()
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                product_ids: Dict[tuple, int] = {}
+                for marketplace, internal_ids in by_marketplace.items():
+                    # цена у неизменившейся карточки та же, значит она всё ещё действует
+                    rows = await conn.fetch(
+                        """
+                        UPDATE products
+                        SET last_scraped_at = now(),
+                            price_seen_at = CASE
+                                WHEN price_seen_at IS NOT NULL THEN now()
+                            END
+                        WHERE marketplace = $1 AND internal_id = ANY($2::bigint[])
+                        RETURNING id, internal_id, size
+                        """,
+                        marketplace, internal_ids
+                    )
+                    product_ids.update(
+                        ((marketplace, row['internal_id'], row['size']), row['id']) for row in rows
+                    )
+
+                if self.price_mode == 'changes':
+                    # карточка не изменилась для этого процесса, но последнюю цену
+                    # в БД мог записать другой воркер - сверяемся с ней
+                    prices = [
+                        (product_ids[key], scraped_at, price)
+                        for product in products
+                        for size, price in product.prices
+                        if price > 0 and (key := (product.marketplace, product.internal_id, size)) in product_ids
+                    ]
+                    await self._insert_prices(conn, await self._changed_prices(conn, prices))
+        logger.debug(f"Marked {len(products)} unchanged products as seen")
+
+    async def save_products_bulk(
+        self,
+        products: List[Dict[str, Any]],
+        batch_size: int = 5000,
+        job_ids: Optional[List[int]] = None,
+        worker_id: Optional[str] = None
+    ) -> List[int]:
+        scraped_at = datetime.now()
+        product_ids = []
+        learned: List[Tuple[tuple, int, int]] = []
+        price_seen_ids: List[int] = []
+
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                for start in range(0, len(products), batch_size):
+                    batch = products[start:start + batch_size]
+                    ids = await self._upsert_products(conn, batch, scraped_at, learned)
+                    prices = [
+                        (product_id, scraped_at, product_data.get('price', 0.0))
+                        for product_id, product_data in zip(ids, batch)
+                        if product_data.get('price', 0.0) > 0
+                    ]
+                    if self.price_mode == 'changes':
+                        price_seen_ids.extend(product_id for product_id, _, _ in prices)
+                        prices = await self._changed_prices(conn, prices)
+                    await self._insert_prices(conn, prices)
+                    product_ids.extend(ids)
+
+                # задания закрываются в той же транзакции, что и запись цен
+                if job_ids:
+                    await self._complete_scrape_jobs(conn, worker_id, job_ids)
+
+        # кэши обновляем только после коммита, иначе при откате в них останутся чужие id
+        for key, product_id, digest in learned:
+            self._product_ids.put(key, product_id)
+            self._product_hashes.put(product_id, digest)
+        self._mark_scraped(product_ids, price_seen_ids)
+        await self._maybe_flush_scraped_at()
+
+        logger.debug(f"Bulk saved {len(product_ids)} products")
+        return product_ids
+
+    async def _upsert_products(
+        self,
+        conn: asyncpg.Connection,
+        products: List[Dict[str, Any]],
+        scraped_at: datetime,
+        learned: List[Tuple[tuple, int, int]]
+    ) -> List[int]:
+        # ON CONFLICT DO UPDATE не может дважды задеть одну строку,
+        # поэтому дубликаты ключа схлопываем (побеждает последний)
+        unique: Dict[tuple, Dict[str, Any]] = {}
+        for product_data in products:
+            key = (product_data['marketplace'], product_data['internal_id'], product_data.get('size'))
+            unique[key] = product_data
+
+        ids: Dict[tuple, int] = {}
+        digests: Dict[tuple, int] = {}
+        rows = []
+        for key, product_data in unique.items():
+            digest = content_hash(tuple(product_data.get(field) for field in PRODUCT_FIELDS))
+            product_id = self._product_ids.get(key)
+            if (self.exclusive_writer and product_id is not None
+                    and self._product_hashes.peek(product_id) == digest):
+                ids[key] = product_id
+            else:
+                digests[key] = digest
+                rows.append(product_data)
+
+        if rows:
+            # неизменённые строки не переписываются и в RETURNING не попадают
+            records = await conn.fetch(
+                """
+                INSERT INTO products (
+                    internal_id, name, marketplace, brand, brand_id,
+                    image_url, size, quantity, pics, last_scraped_at
+                )
+                SELECT u.internal_id, u.name, u.marketplace, u.brand, u.brand_id,
+                       u.image_url, u.size, u.quantity, u.pics, $10
+                FROM unnest(
+                    $1::bigint[], $2::text[], $3::text[], $4::text[], $5::integer[],
+                    $6::text[], $7::text[], $8::integer[], $9::integer[]
+                ) AS u(internal_id, name, marketplace, brand, brand_id,
+                       image_url, size, quantity, pics)
+                ON CONFLICT (marketplace, internal_id, size) DO UPDATE
+                SET name = EXCLUDED.name,
+                    brand = EXCLUDED.brand,
+                    brand_id = EXCLUDED.brand_id,
+                    image_url = EXCLUDED.image_url,
+                    quantity = EXCLUDED.quantity,
+                    pics = EXCLUDED.pics
+                WHERE (products.name, products.brand, products.brand_id,
+                       products.image_url, products.quantity, products.pics)
+                      IS DISTINCT FROM
+                      (EXCLUDED.name, EXCLUDED.brand, EXCLUDED.brand_id,
+                       EXCLUDED.image_url, EXCLUDED.quantity, EXCLUDED.pics)
+                RETURNING id, marketplace, internal_id, size
+                """,
+                [row['internal_id'] for row in rows],
+                [row['name'] for row in rows],
+                [row['marketplace'] for row in rows],
+                [row.get('brand') for row in rows],
+                [row.get('brand_id') for row in rows],
+                [row.get('image_url') for row in rows],
+                [row.get('size') for row in rows],
+                [row.get('quantity') for row in rows],
+                [row.get('pics') for row in rows],
+                scraped_at
+            )
+            for record in records:
+                ids[(record['marketplace'], record['internal_id'], record['size'])] = record['id']
+
+            missing = [key for key in digests if key not in ids]
+            if missing:
+                records = await conn.fetch(
+                    """
+                    SELECT p.id, p.marketplace, p.internal_id, p.size
+                    FROM products p
+                    JOIN unnest($1::text[], $2::bigint[], $3::text[]) AS u(marketplace, internal_id, size)
+                      ON p.marketplace = u.marketplace
+                     AND p.internal_id = u.internal_id
+                     AND p.size = u.size
+                    """,
+                    [key[0] for key in missing],
+                    [key[1] for key in missing],
+                    [key[2] for key in missing]
+                )
+                for record in records:
+                    ids[(record['marketplace'], record['internal_id'], record['size'])] = record['id']
+
+            learned.extend((key, ids[key], digest) for key, digest in digests.items())
+
+        return [
+            ids[(product_data['marketplace'], product_data['internal_id'], product_data.get('size'))]
+            for product_data in products
+        ]
+
+    async def _changed_prices(
+        self,
+        conn: asyncpg.Connection,
+        prices: List[tuple]
+    ) -> List[tuple]:
+        # Сравниваем с product_latest_price, а не с кэшем процесса: цену того же
+        # товара мог записать другой воркер. Вызывается внутри транзакции записи:
+        # строки блокируются до коммита (в порядке id, чтобы не ловить deadlock)
+        if not prices:
+            return []
+        rows = await conn.fetch(
+            """
+            SELECT product_id, price
+            FROM product_latest_price
+            WHERE product_id = ANY($1::bigint[])
+            ORDER BY product_id
+            FOR UPDATE
+            """,
+            sorted({product_id for product_id, _, _ in prices})
+        )
+        known = {row['product_id']: float(row['price']) for row in rows}
+
+        changed = []
+        for product_id, timestamp, price in prices:
+            if known.get(product_id) != price:
+                changed.append((product_id, timestamp, price))
+                known[product_id] = price
+        return changed
+
+    async def _insert_prices(
+        self,
+        conn: asyncpg.Connection,
+        prices: List[tuple]
+    ) -> None:
+        if not prices:
+            return
+
+        # один товар может встретиться в пачке дважды с тем же timestamp
+        unique = {(product_id, timestamp): price for product_id, timestamp, price in prices}
+        await conn.execute(
+            """
+            INSERT INTO prices (product_id, timestamp, price)
+            SELECT * FROM unnest($1::bigint[], $2::timestamptz[], $3::numeric[])
+            ON CONFLICT (product_id, timestamp) DO UPDATE
+            SET price = EXCLUDED.price
+            """,
+            [key[0] for key in unique],
+            [key[1] for key in unique],
+            list(unique.values())
+        )
+        await self._update_latest_prices(
+            conn,
+            [(product_id, timestamp, price) for (product_id, timestamp), price in unique.items()]
+        )
+
+    @staticmethod
+    async def _update_latest_prices(
+        conn: asyncpg.Connection,
+        prices: List[tuple]
+    ) -> None:
+        # более старая цена (например, догруженная история) текущую не перетирает
+        await conn.execute(
+            """
+            INSERT INTO product_latest_price AS latest (product_id, price, timestamp)
+            SELECT DISTINCT ON (product_id)
+                   product_id, price, timestamp
+            FROM unnest($1::bigint[], $2::timestamptz[], $3::numeric[])
+                 AS t (product_id, timestamp, price)
+            ORDER BY product_id, timestamp DESC
+            ON CONFLICT (product_id) DO UPDATE
+            SET price = EXCLUDED.price,
+                timestamp = EXCLUDED.timestamp
+            WHERE latest.timestamp <= EXCLUDED.timestamp
+            """,
+            [product_id for product_id, _, _ in prices],
+            [timestamp for _, timestamp, _ in prices],
+            [price for _, _, price in prices]
+        )
+
+    @staticmethod
+    async def _fetch_latest_prices(
+        conn: asyncpg.Connection,
+        product_ids: List[int]
+    ) -> Dict[int, float]:
+        rows = await conn.fetch(
+            """
+            SELECT product_id, price
+            FROM product_latest_price
+            WHERE product_id = ANY($1::bigint[])
+            """,
+            product_ids
+        )
+        return {row['product_id']: float(row['price']) for row in rows}
+
+    async def enqueue_scrape_jobs(
+        self,
+        marketplace: str,
+        internal_ids: List[int],
+        run_at: Optional[datetime] = None,
+        max_attempts: int = 5
+    ) -> int:
+        if not internal_ids:
+            return 0
+
+        async with self.pool.acquire() as conn:
+            status = await conn.execute(
+                """
+                INSERT INTO scrape_jobs (marketplace, internal_id, run_at, max_attempts)
+                SELECT $1, internal_id, COALESCE($3, now()), $4
+                FROM unnest($2::bigint[]) AS internal_id
+                ON CONFLICT (marketplace, internal_id) DO UPDATE
+                SET run_at = CASE
+                        WHEN scrape_jobs.status = 'pending'
+                        THEN LEAST(scrape_jobs.run_at, EXCLUDED.run_at)
+                        ELSE EXCLUDED.run_at
+                    END,
+                    attempts = CASE
+                        WHEN scrape_jobs.status = 'pending' THEN scrape_jobs.attempts
+                        ELSE 0
+                    END,
+                    max_attempts = EXCLUDED.max_attempts,
+                    status = 'pending',
+                    last_error = NULL
+                WHERE scrape_jobs.status <> 'running'
+                """,
+                marketplace, [int(internal_id) for internal_id in internal_ids], run_at, max_attempts
+            )
+        count = int(status.split()[-1])
+        logger.debug(f"Enqueued {count} scrape jobs for {marketplace}")
+        return count
+
+    async def claim_scrape_jobs(
+        self,
+        worker_id: str,
+        limit: int = 100,
+        lease_seconds: float = 300,
+        marketplace: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                # задания, чья аренда истекла на последней попытке, больше не выдаём
+                await conn.execute(
+                    """
+                    UPDATE scrape_jobs
+                    SET status = 'failed',
+                        locked_by = NULL,
+                        locked_until = NULL,
+                        last_error = COALESCE(last_error, 'lease expired'),
+                        finished_at = now()
+                    WHERE status = 'running'
+                      AND locked_until < now()
+                      AND attempts >= max_attempts
+                    """
+                )
+                rows = await conn.fetch(
+                    """
+                    WITH claimable AS (
+                        SELECT id
+                        FROM scrape_jobs
+                        WHERE ((status = 'pending' AND run_at <= now())
+                               OR (status = 'running' AND locked_until < now()))
+                          AND ($4::text IS NULL OR marketplace = $4)
+                        ORDER BY run_at
+                        LIMIT $2
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    UPDATE scrape_jobs j
+                    SET status = 'running',
+                        locked_by = $1,
+                        locked_until = now() + make_interval(secs => $3),
+                        attempts = j.attempts + 1
+                    FROM claimable c
+                    WHERE j.id = c.id
+                    RETURNING j.id, j.marketplace, j.internal_id, j.attempts
+                    """,
+                    worker_id, limit, lease_seconds, marketplace
+                )
+        return [dict(row) for row in rows]
+
+    async def heartbeat_scrape_jobs(
+        self,
+        worker_id: str,
+        job_ids: List[int],
+        lease_seconds: float = 300
+    ) -> int:
+        async with self.pool.acquire() as conn:
+            status = await conn.execute(
+                """
+                UPDATE scrape_jobs
+                SET locked_until = now() + make_interval(secs => $3)
+                WHERE id = ANY($2::bigint[])
+                  AND status = 'running'
+                  AND locked_by = $1
+                """,
+                worker_id, job_ids, lease_seconds
+            )
+        return int(status.split()[-1])
+
+    async def complete_scrape_jobs(
+        self,
+        worker_id: Optional[str],
+        job_ids: List[int],
+        skip: Iterable[Tuple[str, int]] = ()
+    ) -> None:
+        async with self.pool.acquire() as conn:
+            await self._complete_scrape_jobs(conn, worker_id, job_ids, skip)
+
+    async def _complete_scrape_jobs(
+        self,
+        conn: asyncpg.Connection,
+        worker_id: Optional[str],
+        job_ids: List[int],
+        skip: Iterable[Tuple[str, int]] = ()
+    ) -> None:
+        skip = list(skip)
+        await conn.execute(
+            """
+            UPDATE scrape_jobs
+            SET status = 'done',
+                locked_by = NULL,
+                locked_until = NULL,
+                last_error = NULL,
+                finished_at = now()
+            WHERE id = ANY($1::bigint[])
+              AND ($2::text IS NULL OR locked_by = $2)
+              AND (marketplace, internal_id) NOT IN (
+                  SELECT * FROM unnest($3::text[], $4::bigint[])
+              )
+            """,
+            job_ids, worker_id,
+            [marketplace for marketplace, _ in skip],
+            [internal_id for _, internal_id in skip]
+        )
+
+    async def fail_scrape_jobs(
+        self,
+        worker_id: str,
+        job_ids: List[int],
+        error: str,
+        retry_delay: float = 60
+    ) -> None:
+        async with self.pool.acquire() as conn:
+            await conn.execute(
+                """
+                UPDATE scrape_jobs
+                SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'pending' END,
+                    run_at = now() + make_interval(secs => $4 * power(2, GREATEST(attempts - 1, 0))),
+                    finished_at = CASE WHEN attempts >= max_attempts THEN now() END,
+                    locked_by = NULL,
+                    locked_until = NULL,
+                    last_error = $3
+                WHERE id = ANY($2::bigint[])
+                  AND locked_by = $1
+                """,
+                worker_id, job_ids, error, retry_delay
+            )
+
     async def get_product_price_history(
         self,
         product_id: int,
         limit: Optional[int] = None
     ) -> List[Dict[str, Any]]:
         async with self.pool.acquire() as conn:
-            query = """
+            # LIMIT NULL означает отсутствие ограничения
+            rows = await conn.fetch(
+                """
                 SELECT timestamp, price
                 FROM prices
                 WHERE product_id = $1
                 ORDER BY timestamp DESC
-            """
-            if limit:
-                query += f" LIMIT {limit}"
-            
-            rows = await conn.fetch(query, product_id)
-            return [{'timestamp': row['timestamp'], 'price': float(row['price'])} for row in rows]
+                LIMIT $2
+                """,
+                product_id, limit or None
+            )
+            history = [{'timestamp': row['timestamp'], 'price': float(row['price'])} for row in rows]
+
+            if self.price_mode == 'changes' and history:
+                # в prices лежат только смены цены; последняя цена действует
+                # до момента, когда её видели в последний раз
+                seen_at = await conn.fetchval(
+                    "SELECT price_seen_at FROM products WHERE id = $1",
+                    product_id
+                )
+                if seen_at is not None and seen_at > history[0]['timestamp']:
+                    history.insert(0, {'timestamp': seen_at, 'price': history[0]['price']})
+                    if limit:
+                        history = history[:limit]
+
+            return history
     
+    async def get_price_history_buckets(
+        self,
+        product_id: int,
+        bucket: timedelta = timedelta(days=1),
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None
+    ) -> List[Dict[str, Any]]:
+        async with self.pool.acquire() as conn:
+            rows = await self._fetch_price_buckets(conn, [product_id], bucket, since, until)
+        return [
+            {
+                'bucket': row['bucket'],
+                'open': float(row['open']),
+                'high': float(row['high']),
+                'low': float(row['low']),
+                'close': float(row['close']),
+                'avg': float(row['avg']),
+                'samples': row['samples'],
+            }
+            for row in rows
+        ]
+
+    async def _available_rollups(self, conn: asyncpg.Connection) -> List[Tuple[timedelta, str]]:
+        if self._rollup_views is None:
+            present = await conn.fetchrow(
+                "SELECT " + ", ".join(f"to_regclass('{view}') IS NOT NULL" for _, view in PRICE_ROLLUP_VIEWS)
+            )
+            self._rollup_views = [rollup for rollup, exists in zip(PRICE_ROLLUP_VIEWS, present) if exists]
+        return self._rollup_views
+
+    async def _fetch_price_buckets(
+        self,
+        conn: asyncpg.Connection,
+        product_ids: List[int],
+        bucket: timedelta,
+        since: Optional[datetime],
+        until: Optional[datetime]
+    ) -> List[asyncpg.Record]:
+        query, extra_args = await self._price_buckets_query(conn, bucket)
+        return await conn.fetch(
+            query + " ORDER BY 1, 2",
+            product_ids, bucket, since, until, *extra_args
+        )
+
+    async def _price_buckets_query(
+        self,
+        conn: asyncpg.Connection,
+        bucket: timedelta
+    ) -> Tuple[str, tuple]:
+        # Параметры запроса: $1 - id товаров, $2 - бакет, $3/$4 - границы
+        # по времени; дополнительные параметры возвращаются вместе с запросом
+        if bucket <= timedelta(0):
+            raise ValueError(f"bucket must be positive, got {bucket}")
+
+        # берём самый крупный rollup, бакеты которого укладываются в запрошенный
+        # целиком; если подходящего нет (нет TimescaleDB или бакет мельче часа),
+        # агрегируем сырые цены
+        view = next(
+            (view for size, view in await self._available_rollups(conn) if bucket % size == timedelta(0)),
+            None
+        )
+        if view is not None:
+            query = f"""
+                SELECT product_id,
+                       time_bucket($2::interval, bucket) AS bucket,
+                       first(open, bucket) AS open,
+                       max(high) AS high,
+                       min(low) AS low,
+                       last(close, bucket) AS close,
+                       sum(avg * samples) / sum(samples) AS avg,
+                       sum(samples)::bigint AS samples
+                FROM {view}
+                WHERE product_id = ANY($1::bigint[])
+                  AND ($3::timestamptz IS NULL OR bucket >= $3)
+                  AND ($4::timestamptz IS NULL OR bucket < $4)
+                GROUP BY 1, 2
+            """
+            return query, ()
+
+        query = """
+            SELECT product_id,
+                   date_bin($2::interval, timestamp, $5::timestamptz) AS bucket,
+                   (array_agg(price ORDER BY timestamp))[1] AS open,
+                   max(price) AS high,
+                   min(price) AS low,
+                   (array_agg(price ORDER BY timestamp DESC))[1] AS close,
+                   avg(price) AS avg,
+                   count(*) AS samples
+            FROM prices
+            WHERE product_id = ANY($1::bigint[])
+              AND ($3::timestamptz IS NULL OR timestamp >= $3)
+              AND ($4::timestamptz IS NULL OR timestamp < $4)
+            GROUP BY 1, 2
+        """
+        return query, (BUCKET_ORIGIN,)
+
+    async def get_price_series(
+        self,
+        product_ids: List[int],
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        bucket: Optional[timedelta] = None,
+        field: str = 'close'
+    ) -> PriceSeriesBatch:
+        # Одна строка на товар: массивы времени (мкс от эпохи) и цен собираются
+        # в Postgres, на стороне Python остаётся склеить их в numpy
+        if field not in BUCKET_FIELDS:
+            raise ValueError(f"field must be one of {BUCKET_FIELDS}, got {field!r}")
+
+        async with self.pool.acquire() as conn:
+            if bucket is None:
+                rows = await conn.fetch(
+                    """
+                    SELECT product_id,
+                           array_agg((extract(epoch FROM timestamp) * 1000000)::bigint ORDER BY timestamp),
+                           array_agg(price::float8 ORDER BY timestamp)
+                    FROM prices
+                    WHERE product_id = ANY($1::bigint[])
+                      AND ($2::timestamptz IS NULL OR timestamp >= $2)
+                      AND ($3::timestamptz IS NULL OR timestamp < $3)
+                    GROUP BY product_id
+                    ORDER BY product_id
+                    """,
+                    list(product_ids), since, until
+                )
+            else:
+                query, extra_args = await self._price_buckets_query(conn, bucket)
+                rows = await conn.fetch(
+                    f"""
+                    SELECT product_id,
+                           array_agg((extract(epoch FROM bucket) * 1000000)::bigint ORDER BY bucket),
+                           array_agg({field}::float8 ORDER BY bucket)
+                    FROM ({query}) buckets
+                    GROUP BY product_id
+                    ORDER BY product_id
+                    """,
+                    list(product_ids), bucket, since, until, *extra_args
+                )
+        return PriceSeriesBatch.from_rows(rows)
+
+    async def maintain_partitions(
+        self,
+        months_ahead: int = 3,
+        drop_after: Optional[timedelta] = None
+    ) -> int:
+        # только для prices, секционированной средствами Postgres (без TimescaleDB)
+        async with self.pool.acquire() as conn:
+            partitioned = await conn.fetchval(
+                "SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass('prices')"
+            )
+            if not partitioned:
+                return 0
+            dropped = await conn.fetchval(
+                "SELECT pricelens_maintain_price_partitions($1, $2)",
+                months_ahead, drop_after
+            )
+        if dropped:
+            logger.info(f"Dropped {dropped} expired price partitions")
+        return dropped
+
+    async def get_price_storage_stats(self) -> Dict[str, Any]:
+        async with self.pool.acquire() as conn:
+            # у секционированной prices собственных данных нет, считаем по секциям
+            total_bytes = await conn.fetchval(
+                """
+                SELECT COALESCE(
+                    (SELECT sum(pg_total_relation_size(relid))::bigint FROM pg_partition_tree('prices')),
+                    pg_total_relation_size('prices')
+                )
+                """
+            )
+            stats = {'total_bytes': total_bytes, 'compressed': False}
+            try:
+                # hypertable_size учитывает чанки, pg_total_relation_size видит только родителя
+                hypertable_bytes = await conn.fetchval("SELECT hypertable_size('prices')")
+                row = await conn.fetchrow(
+                    """
+                    SELECT total_chunks,
+                           number_compressed_chunks,
+                           before_compression_total_bytes,
+                           after_compression_total_bytes
+                    FROM hypertable_compression_stats('prices')
+                    """
+                )
+            except asyncpg.PostgresError:
+                # нет TimescaleDB или prices не hypertable
+                return stats
+
+            if hypertable_bytes is not None:
+                stats['total_bytes'] = hypertable_bytes
+            if row is not None and row['number_compressed_chunks']:
+                stats.update(
+                    compressed=True,
+                    total_chunks=row['total_chunks'],
+                    compressed_chunks=row['number_compressed_chunks'],
+                    before_compression_bytes=row['before_compression_total_bytes'],
+                    after_compression_bytes=row['after_compression_total_bytes'],
+                )
+            return stats
+
+    async def iter_price_export(
+        self,
+        marketplace: Optional[str] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        chunk_size: int = 10_000
+    ) -> AsyncIterator[List[asyncpg.Record]]:
+        # Серверный курсор живёт только внутри транзакции; в памяти
+        # одновременно держится не больше chunk_size строк
+        async with self.pool.acquire() as conn:
+            async with conn.transaction(readonly=True):
+                cursor = await conn.cursor(
+                    """
+                    SELECT p.marketplace,
+                           p.internal_id,
+                           p.size,
+                           p.name,
+                           p.brand,
+                           pr.product_id,
+                           pr.timestamp,
+                           pr.price
+                    FROM prices pr
+                    JOIN products p ON p.id = pr.product_id
+                    WHERE ($1::text IS NULL OR p.marketplace = $1)
+                      AND ($2::timestamptz IS NULL OR pr.timestamp >= $2)
+                      AND ($3::timestamptz IS NULL OR pr.timestamp < $3)
+                    """,
+                    marketplace, since, until
+                )
+                while True:
+                    rows = await cursor.fetch(chunk_size)
+                    if not rows:
+                        break
+                    yield rows
+
+    async def get_scrape_candidates(
+        self,
+        since: datetime,
+        marketplace: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(
+                """
+                WITH observed AS (
+                    SELECT product_id,
+                           price,
+                           lag(price) OVER (PARTITION BY product_id ORDER BY timestamp) AS prev_price
+                    FROM prices
+                    WHERE timestamp >= $1
+                ),
+                volatility AS (
+                    SELECT product_id,
+                           COUNT(*) AS observations,
+                           COUNT(*) FILTER (
+                               WHERE prev_price IS NOT NULL AND price <> prev_price
+                           ) AS changes
+                    FROM observed
+                    GROUP BY product_id
+                )
+                SELECT p.marketplace,
+                       p.internal_id,
+                       MAX(p.last_scraped_at) AS last_scraped_at,
+                       COALESCE(SUM(v.observations), 0) AS observations,
+                       COALESCE(SUM(v.changes), 0) AS changes
+                FROM products p
+                LEFT JOIN volatility v ON v.product_id = p.id
+                WHERE $2::text IS NULL OR p.marketplace = $2
+                GROUP BY p.marketplace, p.internal_id
+                """,
+                since, marketplace
+            )
+            return [dict(row) for row in rows]
+
     async def get_product_by_internal_id(
         self,
         internal_id: int,
@@ -201,16 +1241,10 @@ class AsyncDatabase:
             return None
     
     async def get_latest_price(self, product_id: int) -> Optional[float]:
+        return (await self.get_latest_prices([product_id])).get(product_id)
+
+    async def get_latest_prices(self, product_ids: List[int]) -> Dict[int, float]:
+        if not product_ids:
+            return {}
         async with self.pool.acquire() as conn:
-            row = await conn.fetchrow(
-                """
-                SELECT price FROM prices
-                WHERE product_id = $1
-                ORDER BY timestamp DESC
-                LIMIT 1
-                """,
-                product_id
-            )
-            if row:
-                return float(row['price'])
-            return None
+            return await self._fetch_latest_prices(conn, list(product_ids))
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import csv
+import sys
+from datetime import datetime, timezone
+from typing import Optional
+
+from db.repository import AsyncDatabase
+from logger import get_logger
+
+logger = get_logger('export_prices')
+
+COLUMNS = ('marketplace', 'internal_id', 'size', 'name', 'brand', 'product_id', 'timestamp', 'price')
+
+FORMATS = ('csv', 'parquet', 'arrow')
+
+
+class CsvExportWriter:
+
+    def __init__(self, path: str) -> None:
+        self._file = open(path, 'w', newline='', encoding='utf-8')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(COLUMNS)
+
+    def write(self, rows: list) -> None:
+        self._writer.writerows(rows)
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class ArrowExportWriter:
+    # Parquet и Arrow IPC пишутся по одному record batch на чанк курсора
+
+    def __init__(self, path: str, fmt: str) -> None:
+        # pyarrow нужен только для колоночных форматов
+        import pyarrow as pa
+
+        self._pa = pa
+        self._schema = pa.schema([
+            ('marketplace', pa.string()),
+            ('internal_id', pa.int64()),
+            ('size', pa.string()),
+            ('name', pa.string()),
+            ('brand', pa.string()),
+            ('product_id', pa.int64()),
+            ('timestamp', pa.timestamp('us', tz='UTC')),
+            ('price', pa.decimal128(12, 2)),
+        ])
+        if fmt == 'parquet':
+            import pyarrow.parquet as pq
+            self._writer = pq.ParquetWriter(path, self._schema, compression='zstd')
+        else:
+            self._writer = pa.ipc.new_file(path, self._schema)
+
+    def write(self, rows: list) -> None:
+        arrays = [
+            self._pa.array([row[index] for row in rows], type=field.type)
+            for index, field in enumerate(self._schema)
+        ]
+        self._writer.write_batch(self._pa.RecordBatch.from_arrays(arrays, schema=self._schema))
+
+    def close(self) -> None:
+        self._writer.close()
+
+
+def open_writer(path: str, fmt: str):
+    if fmt == 'csv':
+        return CsvExportWriter(path)
+    return ArrowExportWriter(path, fmt)
+
+
+def parse_time(value: str) -> datetime:
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def guess_format(path: str) -> str:
+    if path.endswith('.parquet'):
+        return 'parquet'
+    if path.endswith(('.arrow', '.feather', '.ipc')):
+        return 'arrow'
+    return 'csv'
+
+
+async def export_prices(
+    db: AsyncDatabase,
+    path: str,
+    fmt: str,
+    marketplace: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    chunk_size: int = 10_000,
+) -> int:
+    writer = open_writer(path, fmt)
+    total = 0
+    try:
+        async for rows in db.iter_price_export(marketplace, since, until, chunk_size):
+            writer.write(rows)
+            total += len(rows)
+            logger.debug(f"Exported {total} rows")
+    finally:
+        writer.close()
+    return total
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description='Export price history')
+    parser.add_argument('output', help='output file, format is guessed from the extension')
+    parser.add_argument('--format', choices=FORMATS)
+    parser.add_argument('--marketplace')
+    parser.add_argument('--since', type=parse_time, help='ISO date/time, UTC if no offset is given')
+    parser.add_argument('--until', type=parse_time, help='ISO date/time, exclusive')
+    parser.add_argument('--chunk-size', type=int, default=10_000)
+    parser.add_argument('--db-name', default='pricelens')
+    parser.add_argument('--db-user', default='postgres')
+    parser.add_argument('--db-password', default='postgres')
+    parser.add_argument('--db-host', default='localhost')
+    parser.add_argument('--db-port', type=int, default=5432)
+    args = parser.parse_args()
+
+    db = AsyncDatabase(
+        dbname=args.db_name,
+        user=args.db_user,
+        password=args.db_password,
+        host=args.db_host,
+        port=args.db_port,
+    )
+    try:
+        await db.connect(warm_cache=False)
+        fmt = args.format or guess_format(args.output)
+        total = await export_prices(
+            db, args.output, fmt,
+            marketplace=args.marketplace,
+            since=args.since,
+            until=args.until,
+            chunk_size=args.chunk_size,
+        )
+        logger.info(f"Exported {total} prices to {args.output} ({fmt})")
+    except Exception as e:
+        logger.error(f"Export failed: {e}")
+        sys.exit(1)
+    finally:
+        await db.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,8 +1,30 @@
 import asyncio
 from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from time import monotonic
 
 
+def parse_retry_after(value: float | str | None) -> float | None:
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return max(0.0, float(value))
+
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
 class RateLimiter:
 
     def __init__(
@@ -26,6 +48,7 @@ class RateLimiter:
         self._interval_events: deque[tuple[float, int]] = deque()
         self._period_total = 0
         self._interval_total = 0
+        self._blocked_until = 0.0
         self._lock = asyncio.Lock()
 
     def _delete_expired(self, now: float) -> None:
@@ -74,7 +97,7 @@ class RateLimiter:
             async with self._lock:
                 now = monotonic()
                 self._delete_expired(now)
-                if self._can_take(weight):
+                if now >= self._blocked_until and self._can_take(weight):
                     self._append(now, weight)
                     return
 
@@ -94,10 +117,19 @@ class RateLimiter:
                     window=self.interval,
                     threshold=self.burst,
                 )
-                wait_for = max(wait_period, wait_interval, 0.01)
+                wait_for = max(wait_period, wait_interval, self._blocked_until - now, 0.01)
             await asyncio.sleep(wait_for)
 
-    async def record_response(self, status: int, reserved_weight: int = 1) -> None:
+    async def record_response(
+        self,
+        status: int,
+        reserved_weight: int = 1,
+        retry_after: float | str | None = None,
+    ) -> None:
+        delay = parse_retry_after(retry_after)
+        if delay:
+            self._blocked_until = max(self._blocked_until, monotonic() + delay)
+
         actual_weight = self.weight_for_status(status)
         extra_weight = max(0, actual_weight - reserved_weight)
         if not extra_weight:
@@ -107,3 +139,220 @@ class RateLimiter:
             now = monotonic()
             self._delete_expired(now)
             self._append(now, extra_weight)
+
+
+class _GCRACell:
+    # Одно окно "не больше threshold событий за window" в виде GCRA:
+    # allowance событий можно взять сразу, дальше по одному раз в
+    # emission секунд. emission подобран так, чтобы в любом окне длины
+    # window оказалось не больше threshold событий.
+
+    def __init__(self, window: float, threshold: int, allowance: int) -> None:
+        self.window = window
+        self.tat = 0.0
+        self.configure(threshold, allowance)
+
+    def configure(self, threshold: int, allowance: int) -> None:
+        self.allowance = max(1, min(allowance, threshold - 1))
+        self.emission = self.window / max(1, threshold - self.allowance)
+
+    def delay(self, now: float, weight: int) -> float:
+        tat = max(self.tat, now) + weight * self.emission
+        return tat - now - max(self.allowance, weight) * self.emission
+
+    def take(self, now: float, weight: int) -> None:
+        self.tat = max(self.tat, now) + weight * self.emission
+
+    def block_until(self, until: float) -> None:
+        # после паузы разрешаем только один запрос, без мгновенного запаса
+        self.tat = max(self.tat, until + (self.allowance - 1) * self.emission)
+
+
+class GCRARateLimiter:
+    # Та же пара окон (limit за period, burst за interval), но вместо журнала
+    # событий у каждого окна хранится одно число — theoretical arrival time.
+    # Ожидающие стоят в FIFO-очереди, и будится ровно голова очереди
+    # в момент, когда для неё освобождается место.
+
+    def __init__(
+        self,
+        *,
+        period: float,
+        limit: int,
+        interval: float,
+        burst: int,
+        penalized_status: int = 409,
+        penalty_weight: int = 5,
+        adaptive: bool = False,
+        min_limit: int | None = None,
+        max_limit: int | None = None,
+        increase: float = 1.0,
+        decrease: float = 0.5,
+        backoff_statuses: tuple[int, ...] = (409, 429),
+        backoff_cooldown: float = 5.0,
+    ) -> None:
+        self.period = period
+        self.limit = limit
+        self.interval = interval
+        self.burst = burst
+        self.penalized_status = penalized_status
+        self.penalty_weight = penalty_weight
+
+        # AIMD: пока ответы здоровые, лимит растёт на increase за каждое
+        # окно успешных запросов; на 409/429/5xx умножается на decrease
+        self.adaptive = adaptive
+        self.min_limit = min_limit if min_limit is not None else max(1, limit // 10)
+        self.max_limit = max_limit if max_limit is not None else limit * 2
+        self.increase = increase
+        self.decrease = decrease
+        self.backoff_statuses = backoff_statuses
+        self.backoff_cooldown = backoff_cooldown
+        self._effective_limit = float(limit)
+        self._last_backoff = float('-inf')
+
+        # мгновенный запас общий для обоих окон: половина burst
+        self._allowance = (burst + 1) // 2
+        self._period_cell = _GCRACell(period, limit, self._allowance)
+        self._interval_cell = _GCRACell(interval, burst, self._allowance)
+        self._waiters: deque[tuple[asyncio.Future, int]] = deque()
+        self._timer: asyncio.TimerHandle | None = None
+
+    def _delay(self, now: float, weight: int) -> float:
+        return max(
+            self._period_cell.delay(now, weight),
+            self._interval_cell.delay(now, weight),
+        )
+
+    def _take(self, now: float, weight: int) -> None:
+        self._period_cell.take(now, weight)
+        self._interval_cell.take(now, weight)
+
+    def _wake(self) -> None:
+        self._timer = None
+        while self._waiters:
+            future, weight = self._waiters[0]
+            if future.done():
+                self._waiters.popleft()
+                continue
+
+            now = monotonic()
+            delay = self._delay(now, weight)
+            if delay > 0:
+                self._timer = asyncio.get_running_loop().call_later(delay, self._wake)
+                return
+
+            self._waiters.popleft()
+            self._take(now, weight)
+            future.set_result(None)
+
+    def _reschedule(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+        self._wake()
+
+    @property
+    def effective_limit(self) -> int:
+        return int(self._effective_limit)
+
+    @property
+    def effective_rate(self) -> float:
+        return self.effective_limit / self.period
+
+    def weight_for_status(self, status: int) -> int:
+        return self.penalty_weight if status == self.penalized_status else 1
+
+    def _is_backoff(self, status: int) -> bool:
+        return status in self.backoff_statuses or status >= 500
+
+    def _adapt(self, status: int, now: float) -> None:
+        if self._is_backoff(status):
+            # несколько ответов на одну перегрузку режут лимит один раз
+            if now - self._last_backoff < self.backoff_cooldown:
+                return
+            self._last_backoff = now
+            self._effective_limit = max(self.min_limit, self._effective_limit * self.decrease)
+        elif status < 400:
+            self._effective_limit = min(
+                self.max_limit,
+                self._effective_limit + self.increase / self._effective_limit
+            )
+        else:
+            return
+        self._period_cell.configure(self.effective_limit, self._allowance)
+
+    async def acquire(self, weight: int = 1) -> None:
+        now = monotonic()
+        if not self._waiters and self._delay(now, weight) <= 0:
+            self._take(now, weight)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((future, weight))
+        if len(self._waiters) == 1:
+            self._reschedule()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # если слот уже выдан, он просто пропадает
+            if future.cancelled() and self._waiters and self._waiters[0][0] is future:
+                self._reschedule()
+            raise
+
+    async def record_response(
+        self,
+        status: int,
+        reserved_weight: int = 1,
+        retry_after: float | str | None = None,
+    ) -> None:
+        now = monotonic()
+        changed = False
+
+        delay = parse_retry_after(retry_after)
+        if delay:
+            self._period_cell.block_until(now + delay)
+            self._interval_cell.block_until(now + delay)
+            changed = True
+
+        if self.adaptive:
+            previous = self.effective_limit
+            self._adapt(status, now)
+            changed = changed or self.effective_limit != previous
+
+        actual_weight = self.weight_for_status(status)
+        extra_weight = max(0, actual_weight - reserved_weight)
+        if extra_weight:
+            self._take(now, extra_weight)
+            changed = True
+
+        if changed and self._waiters:
+            self._reschedule()
+
+
+class LimiterRegistry:
+    # Один лимитер на ключ (хост или класс эндпоинтов) на весь процесс,
+    # чтобы несколько скрейперов не считали весь бюджет своим.
+
+    def __init__(self) -> None:
+        self._limiters: dict[str, GCRARateLimiter] = {}
+
+    def get(self, key: str, **options) -> GCRARateLimiter:
+        limiter = self._limiters.get(key)
+        if limiter is None:
+            limiter = GCRARateLimiter(**options)
+            self._limiters[key] = limiter
+        return limiter
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._limiters
+
+    def stats(self) -> dict[str, dict]:
+        return {
+            key: {
+                'effective_limit': limiter.effective_limit,
+                'effective_rate': limiter.effective_rate,
+            }
+            for key, limiter in self._limiters.items()
+        }
+
+
+limiters = LimiterRegistry()
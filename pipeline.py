@@ -0,0 +1,187 @@
+import asyncio
+from dataclasses import dataclass
+from time import monotonic
+from typing import Any, Callable, Iterable, Optional
+
+import aiohttp
+
+from db.repository import AsyncDatabase
+from logger import get_logger, full_log
+from records import UnchangedProduct
+from test_parser import BaseScraper
+
+logger = get_logger('pipeline')
+
+_DONE = object()
+
+
+@dataclass
+class CrawlStats:
+    articles: int = 0
+    batches: int = 0
+    failed_batches: int = 0
+    rows: int = 0
+    saved: int = 0
+    flushes: int = 0
+
+
+class CrawlPipeline:
+    # fetch -> parse -> persist, стадии связаны ограниченными очередями:
+    # если БД не успевает, очереди заполняются и скачивание притормаживает.
+
+    def __init__(
+        self,
+        scraper: BaseScraper,
+        db: AsyncDatabase,
+        *,
+        fetch_workers: int = 8,
+        parse_workers: int = 2,
+        queue_size: int = 32,
+        flush_rows: int = 2000,
+        flush_interval: float = 0.5,
+        on_progress: Optional[Callable[[CrawlStats], None]] = None,
+    ) -> None:
+        self.scraper = scraper
+        self.db = db
+        self.fetch_workers = fetch_workers
+        self.parse_workers = parse_workers
+        self.queue_size = queue_size
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.on_progress = on_progress
+        self.stats = CrawlStats()
+
+    async def run(self, session: aiohttp.ClientSession, articles: Iterable[str | int]) -> CrawlStats:
+        self.stats = CrawlStats()
+        fetch_queue: asyncio.Queue = asyncio.Queue(self.queue_size)
+        parse_queue: asyncio.Queue = asyncio.Queue(self.queue_size)
+        write_queue: asyncio.Queue = asyncio.Queue(self.queue_size)
+
+        writer = asyncio.create_task(self._write(write_queue))
+        parsers = [
+            asyncio.create_task(self._parse(session, parse_queue, write_queue))
+            for _ in range(self.parse_workers)
+        ]
+        fetchers = [
+            asyncio.create_task(self._fetch(session, fetch_queue, parse_queue))
+            for _ in range(self.fetch_workers)
+        ]
+
+        try:
+            await self._feed(articles, fetch_queue)
+            await self._close_stage(fetch_queue, fetchers)
+            await self._close_stage(parse_queue, parsers)
+            await self._close_stage(write_queue, [writer])
+        finally:
+            for task in (*fetchers, *parsers, writer):
+                task.cancel()
+
+        logger.info(
+            f"Crawl finished: {self.stats.articles} articles, {self.stats.rows} rows, "
+            f"{self.stats.saved} saved, {self.stats.failed_batches} failed batches"
+        )
+        return self.stats
+
+    async def _feed(self, articles: Iterable[str | int], fetch_queue: asyncio.Queue) -> None:
+        batch = []
+        for article in articles:
+            batch.append(str(article))
+            if len(batch) >= self.scraper.batch_size:
+                await fetch_queue.put(batch)
+                batch = []
+        if batch:
+            await fetch_queue.put(batch)
+
+    @staticmethod
+    async def _close_stage(queue: asyncio.Queue, workers: list[asyncio.Task]) -> None:
+        for _ in workers:
+            await queue.put(_DONE)
+        await asyncio.gather(*workers)
+
+    async def _fetch(
+        self,
+        session: aiohttp.ClientSession,
+        fetch_queue: asyncio.Queue,
+        parse_queue: asyncio.Queue
+    ) -> None:
+        while (batch := await fetch_queue.get()) is not _DONE:
+            self.stats.articles += len(batch)
+            try:
+                raw = await self.scraper.fetch_raw(session, batch)
+            except Exception as e:
+                self.stats.failed_batches += 1
+                logger.error(f"Failed to fetch {len(batch)} articles starting at {batch[0]}: {e}")
+                continue
+            await parse_queue.put(raw)
+
+    async def _parse(
+        self,
+        session: aiohttp.ClientSession,
+        parse_queue: asyncio.Queue,
+        write_queue: asyncio.Queue
+    ) -> None:
+        while (raw := await parse_queue.get()) is not _DONE:
+            try:
+                rows = await self.scraper.parse_raw(session, raw)
+            except Exception as e:
+                self.stats.failed_batches += 1
+                logger.error(f"Failed to parse batch: {e}")
+                full_log(logger=logger, where="/pipeline/_parse")
+                continue
+            self.stats.batches += 1
+            if rows:
+                await write_queue.put(rows)
+
+    async def _write(self, write_queue: asyncio.Queue) -> None:
+        pending: list[dict] = []
+        deadline = monotonic() + self.flush_interval
+
+        while True:
+            try:
+                rows = await asyncio.wait_for(
+                    write_queue.get(),
+                    timeout=max(0.0, deadline - monotonic())
+                )
+            except asyncio.TimeoutError:
+                rows = None
+
+            if rows is _DONE:
+                break
+            if rows:
+                pending.extend(rows)
+                self.stats.rows += len(rows)
+
+            if len(pending) >= self.flush_rows or monotonic() >= deadline:
+                await self._flush(pending)
+                pending = []
+                deadline = monotonic() + self.flush_interval
+
+        await self._flush(pending)
+        await self.db.flush_scraped_at()
+
+    async def _flush(self, rows: list[dict]) -> None:
+        if not rows:
+            return
+        try:
+            product_ids = await self.db.save_parsed_products(rows)
+        except Exception as e:
+            logger.error(f"Failed to save {len(rows)} rows: {e}")
+            full_log(logger=logger, where="/pipeline/_flush")
+            self.scraper.forget([
+                row['internal_id'] for row in rows if not isinstance(row, UnchangedProduct)
+            ])
+            return
+        self.stats.saved += len(product_ids)
+        self.stats.flushes += 1
+        if self.on_progress is not None:
+            self.on_progress(self.stats)
+
+
+async def crawl(
+    scraper: BaseScraper,
+    db: AsyncDatabase,
+    articles: Iterable[str | int],
+    **options: Any
+) -> CrawlStats:
+    pipeline = CrawlPipeline(scraper, db, **options)
+    return await pipeline.run(scraper.session(), articles)
@@ -0,0 +1,37 @@
+from typing import Any, Optional
+
+import msgspec
+
+
+class ParsedProduct(msgspec.Struct, gc=False):
+    # Одна размерная вариация товара. Хранится без __dict__, но
+    # поддерживает product['name'] и product.get('brand'), как прежние словари.
+    marketplace: str
+    internal_id: int
+    name: str
+    brand: Optional[str] = None
+    brand_id: Optional[int] = None
+    price_basic: float = 0.0
+    price: float = 0.0
+    size: Optional[str] = None
+    quantity: Optional[int] = None
+    image_url: Optional[str] = None
+    pics: Optional[int] = None
+
+    def __getitem__(self, key: str) -> Any:
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return getattr(self, key, default)
+
+
+class UnchangedProduct(msgspec.Struct, gc=False):
+    # Карточка не изменилась с прошлого раза: товар нужно отметить
+    # проверенным, а цены (размер, цена) - сверить с последними в БД,
+    # которые мог изменить другой воркер
+    marketplace: str
+    internal_id: int
+    prices: tuple[tuple[Optional[str], float], ...] = ()
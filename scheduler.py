@@ -0,0 +1,158 @@
+import asyncio
+import heapq
+from datetime import datetime, timedelta, timezone
+from time import time
+from typing import Optional
+
+import aiohttp
+
+from db.repository import AsyncDatabase
+from logger import get_logger, full_log
+from pipeline import CrawlPipeline
+from test_parser import BaseScraper
+
+logger = get_logger('scheduler')
+
+
+class RescrapeScheduler:
+    # Очередь товаров по времени следующей проверки. Интервал зависит от того,
+    # как часто цена реально менялась за lookback: ожидаемое время между
+    # сменами делим на samples_per_change и зажимаем в [min_interval, max_interval].
+
+    def __init__(
+        self,
+        db: AsyncDatabase,
+        scrapers: list[BaseScraper],
+        *,
+        min_interval: float = 3600,
+        max_interval: float = 86400,
+        lookback: timedelta = timedelta(days=7),
+        samples_per_change: int = 4,
+        refresh_interval: float = 3600,
+        max_batch: int = 5000,
+        partition_months_ahead: int = 3,
+        drop_after: Optional[timedelta] = None,
+        **pipeline_options,
+    ) -> None:
+        self.db = db
+        self.scrapers = {scraper.marketplace: scraper for scraper in scrapers}
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.lookback = lookback
+        self.samples_per_change = samples_per_change
+        self.refresh_interval = refresh_interval
+        self.max_batch = max_batch
+        self.partition_months_ahead = partition_months_ahead
+        self.drop_after = drop_after
+        self.pipeline_options = pipeline_options
+
+        self._heap: list[tuple[float, str, int]] = []
+        self._intervals: dict[tuple[str, int], float] = {}
+        self._refreshed_at = float('-inf')
+
+    def __len__(self) -> int:
+        return len(self._intervals)
+
+    def interval_for(self, changes: int) -> float:
+        expected = self.lookback.total_seconds() / (changes + 1)
+        return min(self.max_interval, max(self.min_interval, expected / self.samples_per_change))
+
+    async def refresh(self) -> int:
+        since = datetime.now(timezone.utc) - self.lookback
+        candidates = []
+        for marketplace in self.scrapers:
+            candidates.extend(await self.db.get_scrape_candidates(since, marketplace))
+
+        heap = []
+        intervals = {}
+        now = time()
+        for candidate in candidates:
+            key = (candidate['marketplace'], candidate['internal_id'])
+            interval = self.interval_for(candidate['changes'])
+            last_scraped_at = candidate['last_scraped_at']
+            due = last_scraped_at.timestamp() + interval if last_scraped_at else now
+            intervals[key] = interval
+            heap.append((due, *key))
+
+        # товары, добавленные через add() и ещё не попавшие в БД, не теряем
+        for due, marketplace, internal_id in self._heap:
+            if (marketplace, internal_id) not in intervals:
+                intervals[(marketplace, internal_id)] = self._intervals[(marketplace, internal_id)]
+                heap.append((due, marketplace, internal_id))
+
+        heapq.heapify(heap)
+        self._heap = heap
+        self._intervals = intervals
+        self._refreshed_at = now
+        logger.info(f"Scheduler refreshed: {len(intervals)} articles")
+        return len(intervals)
+
+    async def maintain(self) -> None:
+        # без TimescaleDB секции prices на будущие месяцы создаются здесь
+        try:
+            await self.db.maintain_partitions(self.partition_months_ahead, self.drop_after)
+        except Exception as e:
+            logger.error(f"Failed to maintain price partitions: {e}")
+            full_log(logger=logger, where="/scheduler/maintain")
+
+    def add(self, marketplace: str, internal_id: int, due: Optional[float] = None) -> None:
+        key = (marketplace, int(internal_id))
+        if key in self._intervals:
+            return
+        self._intervals[key] = self.min_interval
+        heapq.heappush(self._heap, (time() if due is None else due, *key))
+
+    def next_due(self) -> Optional[float]:
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: Optional[float] = None) -> dict[str, list[int]]:
+        now = time() if now is None else now
+        due: dict[str, list[int]] = {}
+        taken = 0
+        while self._heap and self._heap[0][0] <= now and taken < self.max_batch:
+            _, marketplace, internal_id = heapq.heappop(self._heap)
+            due.setdefault(marketplace, []).append(internal_id)
+            taken += 1
+        return due
+
+    def reschedule(self, marketplace: str, internal_ids: list[int], now: Optional[float] = None) -> None:
+        now = time() if now is None else now
+        for internal_id in internal_ids:
+            interval = self._intervals.get((marketplace, internal_id), self.min_interval)
+            heapq.heappush(self._heap, (now + interval, marketplace, internal_id))
+
+    async def run_once(self, session: aiohttp.ClientSession) -> int:
+        if time() - self._refreshed_at >= self.refresh_interval:
+            await self.maintain()
+            await self.refresh()
+
+        due = self.pop_due()
+        crawled = 0
+        for marketplace, internal_ids in due.items():
+            pipeline = CrawlPipeline(self.scrapers[marketplace], self.db, **self.pipeline_options)
+            try:
+                await pipeline.run(session, internal_ids)
+            finally:
+                self.reschedule(marketplace, internal_ids)
+            crawled += len(internal_ids)
+        return crawled
+
+    async def run(
+        self,
+        session: aiohttp.ClientSession,
+        stop: Optional[asyncio.Event] = None,
+        idle_sleep: float = 60
+    ) -> None:
+        stop = stop or asyncio.Event()
+        while not stop.is_set():
+            crawled = await self.run_once(session)
+            if crawled:
+                logger.info(f"Scheduler crawled {crawled} articles")
+                continue
+
+            next_due = self.next_due()
+            timeout = idle_sleep if next_due is None else min(idle_sleep, max(0.0, next_due - time()))
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
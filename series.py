@@ -0,0 +1,52 @@
+from dataclasses import dataclass
+from itertools import chain
+from typing import Iterable, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+@dataclass
+class PriceSeriesBatch:
+    # Истории цен многих товаров в плоских массивах: точки товара
+    # product_ids[i] лежат в timestamps/prices[offsets[i]:offsets[i + 1]].
+    # product_ids отсортированы, timestamps - datetime64[us] в UTC.
+    product_ids: np.ndarray
+    offsets: np.ndarray
+    timestamps: np.ndarray
+    prices: np.ndarray
+
+    @classmethod
+    def from_rows(cls, rows: Sequence[Tuple[int, Iterable[int], Iterable[float]]]) -> 'PriceSeriesBatch':
+        # строки (product_id, [мкс от эпохи], [цены]), отсортированные по product_id
+        count = len(rows)
+        product_ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=count)
+        lengths = np.fromiter((len(row[1]) for row in rows), dtype=np.int64, count=count)
+        offsets = np.zeros(count + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        total = int(offsets[-1])
+        timestamps = np.fromiter(chain.from_iterable(row[1] for row in rows), dtype=np.int64, count=total)
+        prices = np.fromiter(chain.from_iterable(row[2] for row in rows), dtype=np.float64, count=total)
+        return cls(product_ids, offsets, timestamps.view('datetime64[us]'), prices)
+
+    def __len__(self) -> int:
+        return len(self.product_ids)
+
+    def __contains__(self, product_id: int) -> bool:
+        return self._index(product_id) is not None
+
+    def _index(self, product_id: int) -> Optional[int]:
+        index = int(np.searchsorted(self.product_ids, product_id))
+        if index < len(self.product_ids) and self.product_ids[index] == product_id:
+            return index
+        return None
+
+    def get(self, product_id: int) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        index = self._index(product_id)
+        if index is None:
+            return None
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self.timestamps[start:end], self.prices[start:end]
+
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
@@ -0,0 +1,69 @@
+import asyncio
+from typing import Optional
+
+import aiohttp
+
+from logger import get_logger
+
+logger = get_logger('sessions')
+
+
+class SessionManager:
+    # Одна aiohttp-сессия на процесс: соединения с card.wb.ru и
+    # basket-NN.wbbasket.ru переиспользуются, DNS кэшируется, и TLS-рукопожатие
+    # не повторяется на каждый запрос.
+
+    def __init__(
+        self,
+        *,
+        limit: int = 200,
+        limit_per_host: int = 32,
+        keepalive_timeout: float = 75,
+        ttl_dns_cache: int = 600,
+        total_timeout: float = 30,
+        connect_timeout: float = 5,
+        sock_read_timeout: float = 15,
+    ) -> None:
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.ttl_dns_cache = ttl_dns_cache
+        self.timeout = aiohttp.ClientTimeout(
+            total=total_timeout,
+            connect=connect_timeout,
+            sock_read=sock_read_timeout,
+        )
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def get(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.ttl_dns_cache,
+                use_dns_cache=True,
+                enable_cleanup_closed=True,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+            self._loop = loop
+            logger.debug("Created shared HTTP session")
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logger.debug("Closed shared HTTP session")
+        self._session = None
+        self._loop = None
+
+    async def __aenter__(self) -> aiohttp.ClientSession:
+        return self.get()
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+
+sessions = SessionManager()
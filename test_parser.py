@@ -1,8 +1,14 @@
 import asyncio
 import aiohttp
 from abc import ABC, abstractmethod
-from typing import Optional
-from limiter import RateLimiter
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Optional
+from limiter import GCRARateLimiter, LimiterRegistry, limiters
+from sessions import SessionManager, sessions
+from cache import LRUCache, PersistentCache
+from records import ParsedProduct, UnchangedProduct
+from wb_schema import CardBatch, WBCard, WBCardResponse, card_decoder, card_fingerprint
+from baskets import BasketResolver
 from db.repository import AsyncDatabase
 
 from logger import get_logger, full_log
@@ -14,11 +20,55 @@ class BaseScraper(ABC):
     product_url: str
     image_url: str
     headers: dict
+    limiter_configs: dict[str, dict] = {}
+    limiters: LimiterRegistry = limiters
+    session_manager: SessionManager = sessions
+    batch_size: int = 1
 
     @abstractmethod
     async def fetch_product(self, session: aiohttp.ClientSession, **kwargs) -> list[dict]:
         raise NotImplementedError
 
+    async def fetch_raw(self, session: aiohttp.ClientSession, articles: list[str]) -> Any:
+        # По умолчанию стадии не разделены: скачиваем и разбираем сразу
+        products = []
+        for article in articles:
+            products.extend(await self.fetch_product(session, article=article))
+        return products
+
+    async def parse_raw(self, session: aiohttp.ClientSession, raw: Any) -> list[dict]:
+        return raw
+
+    def forget(self, internal_ids: list[int]) -> None:
+        # Вызывается, если разобранные товары не удалось сохранить:
+        # скрейпер должен забыть, что уже видел их
+        pass
+
+    def session(self) -> aiohttp.ClientSession:
+        return self.session_manager.get()
+
+    def _limiter(self, endpoint: str) -> GCRARateLimiter:
+        return self.limiters.get(f'{self.marketplace}:{endpoint}', **self.limiter_configs[endpoint])
+
+    @asynccontextmanager
+    async def _request(
+        self,
+        session: aiohttp.ClientSession,
+        method: str,
+        url: str,
+        endpoint: str,
+        **kwargs
+    ) -> AsyncIterator[aiohttp.ClientResponse]:
+        limiter = self._limiter(endpoint)
+        headers = {**self.headers, **kwargs.pop('headers', {})}
+        await limiter.acquire()
+        async with session.request(method, url, headers=headers, **kwargs) as response:
+            await limiter.record_response(
+                response.status,
+                retry_after=response.headers.get('Retry-After')
+            )
+            yield response
+
 
 class WBScraper(BaseScraper):
     marketplace = 'wildberries'
@@ -36,12 +86,46 @@ class WBScraper(BaseScraper):
             'Sec-Fetch-Site': 'cross-site',
         }
     
-    def __init__(self, db: Optional[AsyncDatabase] = None):
-        self._limiter = RateLimiter(
-            period=60, limit=300,
-            interval=0.2, burst=20
-        )
+    limiter_configs = {
+        'card': dict(period=60, limit=300, interval=0.2, burst=20, adaptive=True),
+        'basket': dict(period=60, limit=300, interval=0.2, burst=20, adaptive=True),
+    }
+    cache_path = '.pricelens/cache.sqlite3'
+    probe_wave_size = 8
+    batch_size = 100
+    card_concurrency = 8
+    fingerprint_cache_size = 200_000
+
+    def __init__(
+        self,
+        db: Optional[AsyncDatabase] = None,
+        baskets: Optional[BasketResolver] = None,
+        cache: Optional[PersistentCache] = None,
+        skip_unchanged: Optional[bool] = None
+    ):
         self.db = db
+        # неизменившиеся карточки можно пропускать только при хранении смен цены:
+        # в режиме 'full' каждое наблюдение должно дать строку в prices
+        if skip_unchanged is None:
+            skip_unchanged = db is not None and db.price_mode == 'changes'
+        self.skip_unchanged = skip_unchanged
+        self.cache = cache if cache is not None else PersistentCache(self.cache_path)
+        self._baskets = baskets if baskets is not None else BasketResolver(self.cache.namespace('wb_baskets'))
+        self._pending_baskets: dict[str, asyncio.Future] = {}
+        # vol, чья корзина из кэша уже подтверждена в этом процессе
+        self._verified_vols: set[str] = set()
+        # article -> [отпечаток карточки, [[размер, цена], ...]]: цены нужны,
+        # чтобы для неизменившейся карточки сверить их с последними в БД
+        self._card_states: LRUCache[int, list] = LRUCache(
+            self.fingerprint_cache_size,
+            backing=self.cache.namespace('wb_card_states')
+        )
+        self._validators: LRUCache[str, tuple[Optional[str], Optional[str]]] = LRUCache(
+            self.fingerprint_cache_size,
+            backing=self.cache.namespace('wb_validators')
+        )
+        # в каком запросе (ключ валидаторов) артикул запрашивался последним
+        self._article_chunks: LRUCache[int, str] = LRUCache(self.fingerprint_cache_size)
     
     @staticmethod
     def _get_vol_and_part(article: str) -> tuple[str, str]:
@@ -72,16 +156,17 @@ class WBScraper(BaseScraper):
             article = url.lstrip('https://www.wildberries.ru/catalog/').rstrip('/detail.aspx')
         return str(article)
 
-    async def fetch_product(self, session: aiohttp.ClientSession, **kwargs) -> list[dict]:
+    async def fetch_product(self, session: aiohttp.ClientSession, **kwargs) -> list[ParsedProduct]:
         article = self._get_article(**kwargs)
         url = self._get_url(self.product_url, article)
         print(url)
-        async with session.get(url=url, headers=self.headers) as response:
+        async with self._request(session, 'GET', url, 'card') as response:
             status = response.status
 
             if status == 200:
-                data = await response.json()
-                image_url = await self._get_product_image(session, article)
+                data = card_decoder.decode(await response.read())
+                pics = data.products[0].pics if data.products else None
+                image_url = await self._get_product_image(session, article, pics)
                 product_info = self._parse_product(data, image_url)
                 return product_info
 
@@ -89,68 +174,242 @@ class WBScraper(BaseScraper):
             snippet = text.replace('\n', ' ')
             full_log(logger=logger, where="/fetch_product")
             raise RuntimeError(f'Unexpected status {status} for {article}: {snippet}')
-        
-    def _parse_product(self, data: dict, image_url: str) -> list[dict]:
-        product = data['products'][0]
-        internal_id = product['id']
-        name = product['name']
-        brand = product['brand']
-        brand_id = product['brandId']
-        pics = product['pics']
+
+    async def fetch_products(
+        self,
+        session: aiohttp.ClientSession,
+        articles: list[str | int]
+    ) -> list[ParsedProduct | UnchangedProduct]:
+        articles = [str(article) for article in articles]
+        chunks = [
+            articles[start:start + self.batch_size]
+            for start in range(0, len(articles), self.batch_size)
+        ]
+        semaphore = asyncio.Semaphore(self.card_concurrency)
+
+        async def fetch_chunk(chunk: list[str]) -> list[ParsedProduct | UnchangedProduct]:
+            async with semaphore:
+                data = await self.fetch_raw(session, chunk)
+            return await self.parse_raw(session, data)
+
+        results = await asyncio.gather(
+            *(fetch_chunk(chunk) for chunk in chunks),
+            return_exceptions=True
+        )
+
+        parsed_data = []
+        for chunk, result in zip(chunks, results):
+            if isinstance(result, BaseException):
+                logger.error(f"Failed to fetch {len(chunk)} articles starting at {chunk[0]}: {result}")
+                continue
+            parsed_data.extend(result)
+
+        logger.info(f"Fetched {len(parsed_data)} product variants for {len(articles)} articles")
+        return parsed_data
+
+    async def parse_raw(
+        self,
+        session: aiohttp.ClientSession,
+        raw: CardBatch
+    ) -> list[ParsedProduct | UnchangedProduct]:
+        if raw.response is None:
+            # условный запрос отправляется, только если состояние есть у всех артикулов
+            return [self._unchanged(int(article)) for article in raw.articles]
 
         parsed_data = []
-        for size in product['sizes']:
-            size_name = size['name']
+        changed = []
+        for product in raw.response.products:
+            fingerprint = card_fingerprint(product) if self.skip_unchanged else None
+            state = self._card_states.get(product.id) if self.skip_unchanged else None
+            if state is not None and state[0] == fingerprint:
+                parsed_data.append(self._unchanged(product.id))
+            else:
+                changed.append((product, fingerprint))
+
+        image_urls = await asyncio.gather(
+            *(self._get_product_image(session, str(product.id), product.pics) for product, _ in changed)
+        )
+        for (product, fingerprint), image_url in zip(changed, image_urls):
+            rows = self._parse_card(product, image_url)
+            parsed_data.extend(rows)
+            if self.skip_unchanged:
+                self._card_states.put(product.id, [fingerprint, [[row.size, row.price] for row in rows]])
+
+        if self.skip_unchanged:
+            # артикулы, которых нет в ответе, тоже запоминаем, иначе запрос
+            # с ними никогда не станет условным
+            returned = {product.id for product in raw.response.products}
+            for article in raw.articles:
+                if int(article) not in returned:
+                    self._card_states.put(int(article), [None, []])
+        return parsed_data
+
+    def _unchanged(self, internal_id: int) -> UnchangedProduct:
+        state = self._card_states.get(internal_id)
+        prices = tuple((size, price) for size, price in state[1]) if state is not None else ()
+        return UnchangedProduct(self.marketplace, internal_id, prices)
+
+    def forget(self, internal_ids: list[int]) -> None:
+        # без валидаторов следующий запрос этих артикулов вернёт 200, а не 304
+        for internal_id in internal_ids:
+            self._card_states.pop(internal_id)
+            nm = self._article_chunks.peek(internal_id)
+            if nm is not None:
+                self._validators.pop(nm)
+
+    async def fetch_raw(self, session: aiohttp.ClientSession, articles: list[str]) -> CardBatch:
+        nm = ';'.join(articles)
+        url = self._get_url(self.product_url, nm)
+        for article in articles:
+            self._article_chunks.put(int(article), nm)
+
+        headers = {}
+        validators = self._validators.get(nm) if self.skip_unchanged else None
+        if validators is not None and all(self._card_states.peek(int(article)) is not None for article in articles):
+            etag, last_modified = validators
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        async with self._request(session, 'GET', url, 'card', headers=headers) as response:
+            status = response.status
+            if status == 304:
+                return CardBatch(articles=articles, response=None)
+
+            if status == 200:
+                etag = response.headers.get('ETag')
+                last_modified = response.headers.get('Last-Modified')
+                if self.skip_unchanged and (etag or last_modified):
+                    self._validators.put(nm, (etag, last_modified))
+                return CardBatch(articles=articles, response=card_decoder.decode(await response.read()))
+
+            text = await response.text()
+            snippet = text.replace('\n', ' ')[:200]
+            raise RuntimeError(f'Unexpected status {status} for {len(articles)} articles: {snippet}')
+
+    def _parse_product(self, data: WBCardResponse, image_url: str) -> list[ParsedProduct]:
+        return self._parse_card(data.products[0], image_url)
+
+    def _parse_card(self, product: WBCard, image_url: str) -> list[ParsedProduct]:
+        parsed_data = []
+        for size in product.sizes:
             price_basic, price = 0.0, 0.0
             quantity = 0
 
-            price_dict = size.get('price', None)
-            if price_dict is not None:
-                price_basic = price_dict['basic'] / 100
-                price = price_dict['product'] / 100
-                quantity = size['stocks'][0]['qty']
-
-            parsed_data.append({
-                'marketplace': self.marketplace,
-                'internal_id': internal_id,
-                'name': name,
-                'brand': brand,
-                'brand_id': brand_id,
-                'price_basic': price_basic,
-                'price': price,
-                'size': size_name,
-                'quantity': quantity,
-                'image_url': image_url,
-                'pics': pics
-            })
+            if size.price is not None:
+                price_basic = size.price.basic / 100
+                price = size.price.product / 100
+                quantity = size.stocks[0].qty if size.stocks else 0
+
+            parsed_data.append(ParsedProduct(
+                marketplace=self.marketplace,
+                internal_id=product.id,
+                name=product.name,
+                brand=product.brand,
+                brand_id=product.brand_id,
+                price_basic=price_basic,
+                price=price,
+                size=size.name,
+                quantity=quantity,
+                image_url=image_url,
+                pics=product.pics
+            ))
 
         return parsed_data
 
-    async def _get_product_image(self, session: aiohttp.ClientSession, article: str) -> str:
+    async def _get_product_image(
+        self,
+        session: aiohttp.ClientSession,
+        article: str,
+        pics: Optional[int] = None
+    ) -> str:
         vol, part = self._get_vol_and_part(article)
-        image_url = ''
         try:
-            for num in range(1, 100):
-                basket = f'{num:02d}'
-                url = self._get_url(self.image_url, article, basket, vol, part)
-
-                if self._limiter:
-                    await self._limiter.acquire()
-
-                async with session.get(url, headers=self.headers) as response:
-                    if self._limiter:
-                        await self._limiter.record_response(response.status)
-
-                    if response.status == 200:
-                        content_type = response.headers.get('Content-Type', '')
-                        if content_type.startswith('image/'):
-                            image_url = url
-                            break
+            basket = self._baskets.get(vol)
+            if pics == 0:
+                # у карточки без фото 1.webp нет ни на одном хосте: пробы ничего
+                # не найдут, а проверка кэша ошибочно сбросила бы рабочую корзину
+                pass
+            elif basket is None or vol not in self._verified_vols:
+                basket = await self._resolve_basket(session, article, vol, part)
         except Exception as e:
             full_log(logger=logger, where="/_get_product_image")
             raise e
-        
-        return image_url
+
+        if basket is None:
+            return ''
+        return self._get_url(self.image_url, article, basket, vol, part)
+
+    async def _resolve_basket(
+        self,
+        session: aiohttp.ClientSession,
+        article: str,
+        vol: str,
+        part: str
+    ) -> Optional[str]:
+        pending = self._pending_baskets.get(vol)
+        if pending is None:
+            pending = asyncio.ensure_future(self._verify_or_probe(session, article, vol, part))
+            self._pending_baskets[vol] = pending
+            pending.add_done_callback(lambda _: self._pending_baskets.pop(vol, None))
+        return await asyncio.shield(pending)
+
+    async def _verify_or_probe(
+        self,
+        session: aiohttp.ClientSession,
+        article: str,
+        vol: str,
+        part: str
+    ) -> Optional[str]:
+        # Карта vol -> basket живёт на диске неделями, а WB может перенести vol
+        # на другой хост; поэтому корзину из кэша один раз за процесс проверяем
+        basket = self._baskets.get(vol)
+        if basket is not None:
+            if await self._probe_image(session, self._get_url(self.image_url, article, basket, vol, part)):
+                self._verified_vols.add(vol)
+                return basket
+            logger.info(f"Cached basket-{basket} no longer serves vol {vol}, probing again")
+            self._baskets.invalidate(vol)
+
+        basket = await self._probe_baskets(session, article, vol, part)
+        if basket is not None:
+            self._verified_vols.add(vol)
+        return basket
+
+    async def _probe_baskets(
+        self,
+        session: aiohttp.ClientSession,
+        article: str,
+        vol: str,
+        part: str
+    ) -> Optional[str]:
+        candidates = self._baskets.candidates(vol)
+        for start in range(0, len(candidates), self.probe_wave_size):
+            wave = candidates[start:start + self.probe_wave_size]
+            urls = [self._get_url(self.image_url, article, basket, vol, part) for basket in wave]
+            found = await asyncio.gather(*(self._probe_image(session, url) for url in urls))
+            for basket, ok in zip(wave, found):
+                if ok:
+                    self._baskets.put(vol, basket)
+                    logger.debug(f"Resolved vol {vol} to basket-{basket}")
+                    return basket
+
+        logger.warning(f"No basket host serves images for article {article}")
+        return None
+
+    async def _probe_image(self, session: aiohttp.ClientSession, url: str) -> bool:
+        # несуществующие basket-хосты (большие номера) не резолвятся; это промах,
+        # а не повод ронять всю волну вместе с найденной в ней корзиной
+        try:
+            async with self._request(session, 'HEAD', url, 'basket', allow_redirects=False) as response:
+                if response.status != 200:
+                    return False
+                content_type = response.headers.get('Content-Type', '')
+                return content_type.startswith('image/')
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.debug(f"Probe of {url} failed: {e}")
+            return False
 
     async def save_to_db(self, products: list[dict]) -> list[int]:
         if self.db is None:
@@ -183,7 +442,7 @@ async def main() -> None:
         scraper = WBScraper(db=db)
 
         url = 'https://www.wildberries.ru/catalog/15728047/detail.aspx'
-        async with aiohttp.ClientSession() as session:
+        async with scraper.session_manager as session:
             product_info = await scraper.fetch_product(session, url=url)
 
         print(f"Parsed {len(product_info)} product variants:\n")
@@ -209,7 +468,7 @@ async def main() -> None:
 async def main_without_db() -> None:
     url = 'https://www.wildberries.ru/catalog/15728047/detail.aspx'
     scraper = WBScraper()
-    async with aiohttp.ClientSession() as session:
+    async with scraper.session_manager as session:
         product_info = await scraper.fetch_product(session, url=url)
     for product in product_info:
         print(product, 2*'\n')
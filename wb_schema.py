@@ -0,0 +1,50 @@
+import hashlib
+from typing import Optional
+
+import msgspec
+
+# Только те поля ответа card.wb.ru, которые мы используем; остальное
+# msgspec пропускает при декодировании, не создавая объектов.
+
+
+class WBPrice(msgspec.Struct, gc=False):
+    basic: int = 0
+    product: int = 0
+
+
+class WBStock(msgspec.Struct, gc=False):
+    qty: int = 0
+
+
+class WBSize(msgspec.Struct, gc=False):
+    name: str = ''
+    price: Optional[WBPrice] = None
+    stocks: list[WBStock] = []
+
+
+class WBCard(msgspec.Struct, gc=False):
+    id: int
+    name: str = ''
+    brand: str = ''
+    brand_id: int = msgspec.field(default=0, name='brandId')
+    pics: int = 0
+    sizes: list[WBSize] = []
+
+
+class WBCardResponse(msgspec.Struct, gc=False):
+    products: list[WBCard] = []
+
+
+class CardBatch(msgspec.Struct, gc=False):
+    # response = None, если сервер ответил 304 Not Modified
+    articles: list[str]
+    response: Optional[WBCardResponse]
+
+
+card_decoder = msgspec.json.Decoder(WBCardResponse)
+_card_encoder = msgspec.json.Encoder()
+
+
+def card_fingerprint(card: WBCard) -> int:
+    digest = hashlib.blake2b(_card_encoder.encode(card), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
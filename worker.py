@@ -0,0 +1,121 @@
+import asyncio
+import os
+import socket
+from time import monotonic
+from typing import Optional
+
+import aiohttp
+
+from db.repository import AsyncDatabase
+from logger import get_logger, full_log
+from test_parser import BaseScraper
+
+logger = get_logger('worker')
+
+
+class ScrapeJobWorker:
+    # Забирает задания из scrape_jobs (FOR UPDATE SKIP LOCKED), продлевает
+    # аренду, пока их обрабатывает, и закрывает их в той же транзакции,
+    # что и запись цен. Таких воркеров можно запускать сколько угодно.
+
+    def __init__(
+        self,
+        db: AsyncDatabase,
+        scrapers: list[BaseScraper],
+        *,
+        worker_id: Optional[str] = None,
+        claim_size: int = 500,
+        lease_seconds: float = 300,
+        retry_delay: float = 60,
+        idle_sleep: float = 5,
+        maintenance_interval: float = 3600,
+    ) -> None:
+        self.db = db
+        self.scrapers = {scraper.marketplace: scraper for scraper in scrapers}
+        self.worker_id = worker_id or f'{socket.gethostname()}:{os.getpid()}'
+        self.claim_size = claim_size
+        self.lease_seconds = lease_seconds
+        self.retry_delay = retry_delay
+        self.idle_sleep = idle_sleep
+        self.maintenance_interval = maintenance_interval
+        self._maintained_at = float('-inf')
+
+    async def run_once(self, session: aiohttp.ClientSession) -> int:
+        jobs = await self.db.claim_scrape_jobs(self.worker_id, self.claim_size, self.lease_seconds)
+        if not jobs:
+            return 0
+
+        job_ids = [job['id'] for job in jobs]
+        heartbeat = asyncio.create_task(self._heartbeat(job_ids))
+        try:
+            by_marketplace: dict[str, list[dict]] = {}
+            for job in jobs:
+                by_marketplace.setdefault(job['marketplace'], []).append(job)
+
+            await asyncio.gather(*(
+                self._process(session, marketplace, marketplace_jobs)
+                for marketplace, marketplace_jobs in by_marketplace.items()
+            ))
+            # last_scraped_at/price_seen_at копятся в памяти; воркер живёт долго,
+            # поэтому сбрасываем их после каждой пачки, как и CrawlPipeline
+            await self.db.flush_scraped_at()
+        finally:
+            heartbeat.cancel()
+        return len(jobs)
+
+    async def run(self, session: aiohttp.ClientSession, stop: Optional[asyncio.Event] = None) -> None:
+        stop = stop or asyncio.Event()
+        logger.info(f"Worker {self.worker_id} started")
+        while not stop.is_set():
+            if monotonic() - self._maintained_at >= self.maintenance_interval:
+                await self.maintain()
+            processed = await self.run_once(session)
+            if processed:
+                continue
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=self.idle_sleep)
+            except asyncio.TimeoutError:
+                pass
+        logger.info(f"Worker {self.worker_id} stopped")
+
+    async def maintain(self) -> None:
+        # секции prices на будущие месяцы (только без TimescaleDB); функция в БД
+        # берёт advisory lock, так что одновременный вызов с разных воркеров безопасен
+        self._maintained_at = monotonic()
+        try:
+            await self.db.maintain_partitions()
+        except Exception as e:
+            logger.error(f"Failed to maintain price partitions: {e}")
+            full_log(logger=logger, where="/worker/maintain")
+
+    async def _heartbeat(self, job_ids: list[int]) -> None:
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            await self.db.heartbeat_scrape_jobs(self.worker_id, job_ids, self.lease_seconds)
+
+    async def _process(self, session: aiohttp.ClientSession, marketplace: str, jobs: list[dict]) -> None:
+        scraper = self.scrapers.get(marketplace)
+        if scraper is None:
+            await self.db.fail_scrape_jobs(
+                self.worker_id, [job['id'] for job in jobs],
+                f'No scraper for marketplace {marketplace}', self.retry_delay
+            )
+            return
+
+        batches = [
+            jobs[start:start + scraper.batch_size]
+            for start in range(0, len(jobs), scraper.batch_size)
+        ]
+        await asyncio.gather(*(self._process_batch(session, scraper, batch) for batch in batches))
+
+    async def _process_batch(self, session: aiohttp.ClientSession, scraper: BaseScraper, jobs: list[dict]) -> None:
+        job_ids = [job['id'] for job in jobs]
+        try:
+            raw = await scraper.fetch_raw(session, [str(job['internal_id']) for job in jobs])
+            rows = await scraper.parse_raw(session, raw)
+            await self.db.save_parsed_products(rows, job_ids=job_ids, worker_id=self.worker_id)
+        except Exception as e:
+            logger.error(f"Failed to process {len(jobs)} jobs for {scraper.marketplace}: {e}")
+            full_log(logger=logger, where="/worker/_process_batch")
+            scraper.forget([job['internal_id'] for job in jobs])
+            await self.db.fail_scrape_jobs(self.worker_id, job_ids, str(e), self.retry_delay)